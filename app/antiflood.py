@@ -0,0 +1,123 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import TelegramObject, Update, User
+
+from app.config import (
+    ADMIN_IDS,
+    FLOOD_BURST,
+    FLOOD_INLINE_BURST,
+    FLOOD_INLINE_RATE,
+    FLOOD_MAX_USERS,
+    FLOOD_RATE,
+    FLOOD_WARN_INTERVAL,
+)
+from app.metrics import Counter
+from app.services.sender import background_priority
+
+# Updates a user produces on purpose; join requests and membership changes are never throttled
+_LIMITED_TYPES = {"message", "edited_message", "callback_query", "inline_query"}
+_WARNING = "Too many requests. Please slow down and try again in a moment."
+
+flood_dropped = Counter("kino_flood_dropped_total", "Updates dropped by the anti-flood limit", ("update_type",))
+
+
+# Outer update middleware: a token bucket per user (and a separate one for their inline queries),
+# stored as a bare (tokens, updated, warned_at) tuple in an OrderedDict kept in last-seen order,
+# so idle users fall off the front.
+class FloodControl(BaseMiddleware):
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        warn_interval: float,
+        max_users: int,
+        inline_rate: float,
+        inline_burst: float,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.inline_rate = inline_rate
+        self.inline_burst = inline_burst
+        self.warn_interval = warn_interval
+        self.max_users = max_users
+        # After this long a bucket is full again and the warning window has passed,
+        # so forgetting the user changes nothing
+        self.idle_after = max(burst / rate, inline_burst / inline_rate, warn_interval)
+        # (user id, is inline query) -> bucket
+        self._users: "OrderedDict[Tuple[int, bool], Tuple[float, float, float]]" = OrderedDict()
+
+    def _take(self, user_id: int, inline: bool, now: float) -> Tuple[bool, bool]:
+        # Returns (allowed, warn)
+        rate, burst = (self.inline_rate, self.inline_burst) if inline else (self.rate, self.burst)
+        key = (user_id, inline)
+        state = self._users.pop(key, None)
+        if state is None:
+            tokens, warned_at = burst, 0.0
+        else:
+            tokens, updated, warned_at = state
+            tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        warn = False
+        if allowed:
+            tokens -= 1
+        elif now - warned_at >= self.warn_interval:
+            warn = True
+            warned_at = now
+        self._users[key] = (tokens, now, warned_at)
+        self._evict(now)
+        return allowed, warn
+
+    def _evict(self, now: float) -> None:
+        while self._users:
+            _, (_, updated, _) = next(iter(self._users.items()))
+            if len(self._users) <= self.max_users and now - updated < self.idle_after:
+                return
+            self._users.popitem(last=False)
+
+    async def _reject(self, bot: Bot, event: Update, warn: bool) -> None:
+        # Buttons and inline queries are always answered, or the client keeps spinning;
+        # messages only get the occasional warning
+        try:
+            with background_priority():
+                if event.message is not None:
+                    if warn:
+                        await bot.send_message(event.message.chat.id, _WARNING)
+                elif event.callback_query is not None:
+                    await bot.answer_callback_query(event.callback_query.id, _WARNING if warn else None)
+                elif event.inline_query is not None:
+                    # Not cached, so the same query works again once the user slows down
+                    await bot.answer_inline_query(event.inline_query.id, [], cache_time=0, is_personal=True)
+        except Exception as e:  # noqa
+            logging.error(e)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User = data.get("event_from_user")
+        if user is None or user.id in ADMIN_IDS or event.event_type not in _LIMITED_TYPES:
+            return await handler(event, data)
+        allowed, warn = self._take(user.id, event.event_type == "inline_query", time.monotonic())
+        if allowed:
+            return await handler(event, data)
+        flood_dropped.inc(event.event_type)
+        await self._reject(data["bot"], event, warn)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+flood_control = FloodControl(
+    rate=FLOOD_RATE,
+    burst=FLOOD_BURST,
+    warn_interval=FLOOD_WARN_INTERVAL,
+    max_users=FLOOD_MAX_USERS,
+    inline_rate=FLOOD_INLINE_RATE,
+    inline_burst=FLOOD_INLINE_BURST,
+)
@@ -0,0 +1,320 @@
+import bisect
+import heapq
+import re
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from app.cache import BloomFilter, LRUCache
+from app.config import MOVIE_CACHE_SIZE, MOVIE_FILTER_ERROR_RATE
+
+
+class Movie(NamedTuple):
+    code: str
+    file_id: str
+    storage_message_id: Optional[int]
+    name: Optional[str]
+    description: Optional[str]
+    # Rendered once when the movie is saved: what users receive, and the storage channel post
+    caption: str
+    storage_caption: str
+    # Later parts of a multi-part title, in order; file_id is the first part
+    extra_file_ids: Tuple[str, ...] = ()
+
+    @property
+    def file_ids(self) -> Tuple[str, ...]:
+        return (self.file_id,) + self.extra_file_ids
+
+
+# Spare room so codes added at runtime don't degrade the filter before the next restart
+_FILTER_HEADROOM = 2
+_FILTER_MIN_CAPACITY = 10_000
+
+
+class PrefixIndex:
+    def __init__(self):
+        # Sorted (key, code) pairs; keys are the code, the title and every word-start suffix of the title
+        self._entries: List[Tuple[str, str]] = []
+        self._keys: Dict[str, List[str]] = {}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.casefold().split())
+
+    @classmethod
+    def _keys_for(cls, code: str, name: Optional[str]) -> List[str]:
+        keys = {cls.normalize(code)}
+        if name:
+            title = cls.normalize(name)
+            keys.add(title)
+            keys.update(title[match.start():] for match in re.finditer(r"\w+", title))
+        keys.discard("")
+        return sorted(keys)
+
+    @classmethod
+    def build(cls, movies: Iterable[Tuple[str, Optional[str]]]) -> "PrefixIndex":
+        index = cls()
+        for code, name in movies:
+            keys = cls._keys_for(code, name)
+            index._keys[code] = keys
+            index._entries.extend((key, code) for key in keys)
+        index._entries.sort()
+        return index
+
+    def add(self, code: str, name: Optional[str]) -> None:
+        self.remove(code)
+        keys = self._keys_for(code, name)
+        self._keys[code] = keys
+        for key in keys:
+            bisect.insort(self._entries, (key, code))
+
+    def indexed(self, code: str, name: Optional[str]) -> bool:
+        return self._keys.get(code) == self._keys_for(code, name)
+
+    def remove(self, code: str) -> None:
+        for key in self._keys.pop(code, ()):
+            idx = bisect.bisect_left(self._entries, (key, code))
+            if idx < len(self._entries) and self._entries[idx] == (key, code):
+                del self._entries[idx]
+
+    def search(self, prefix: str, limit: int, offset: int = 0) -> List[str]:
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        codes: List[str] = []
+        seen = set()
+        idx = bisect.bisect_left(self._entries, (prefix, ""))
+        while idx < len(self._entries) and len(codes) < offset + limit:
+            key, code = self._entries[idx]
+            if not key.startswith(prefix):
+                break
+            if code not in seen:
+                seen.add(code)
+                codes.append(code)
+            idx += 1
+        return codes[offset:]
+
+
+# Trigrams shared by more codes than this ("  1" in a numeric catalog) say little about a match;
+# they are skipped whenever the query has a rarer one
+_COMMON_TRIGRAM = 2000
+_MIN_SIMILARITY = 0.3
+# Single-character edits are only tried over small code alphabets (digits, Latin letters)
+_MAX_EDIT_ALPHABET = 64
+
+
+class TrigramIndex:
+    def __init__(self):
+        # Normalized code -> the codes with that form, and trigram -> normalized codes containing it
+        self._codes: Dict[str, List[str]] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._alphabet: Set[str] = set()
+        # Like the alphabet, only ever grows; bounds the inputs worth looking up
+        self._longest = 0
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        return "".join(code.casefold().split())
+
+    @staticmethod
+    def _trigrams_of(normalized: str) -> Set[str]:
+        padded = f"  {normalized} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    @classmethod
+    def build(cls, codes: Iterable[str]) -> "TrigramIndex":
+        index = cls()
+        for code in codes:
+            index.add(code)
+        return index
+
+    def add(self, code: str) -> None:
+        normalized = self.normalize(code)
+        if not normalized:
+            return
+        codes = self._codes.setdefault(normalized, [])
+        if code in codes:
+            return
+        codes.append(code)
+        if len(codes) == 1:
+            for trigram in self._trigrams_of(normalized):
+                self._trigrams.setdefault(trigram, set()).add(normalized)
+            self._alphabet.update(normalized)
+            self._longest = max(self._longest, len(normalized))
+
+    def remove(self, code: str) -> None:
+        normalized = self.normalize(code)
+        codes = self._codes.get(normalized)
+        if not codes or code not in codes:
+            return
+        codes.remove(code)
+        if codes:
+            return
+        del self._codes[normalized]
+        for trigram in self._trigrams_of(normalized):
+            postings = self._trigrams.get(trigram)
+            if postings is not None:
+                postings.discard(normalized)
+                if not postings:
+                    del self._trigrams[trigram]
+
+    def _plausible(self, normalized: str) -> bool:
+        # Longer than any code plus one edit can't match, and would make _edits build
+        # thousands of copies of a long message
+        return 0 < len(normalized) <= self._longest + 1
+
+    def match(self, code: str) -> Optional[str]:
+        # The one code equal to this one up to case and whitespace
+        normalized = self.normalize(code)
+        if not self._plausible(normalized):
+            return None
+        codes = self._codes.get(normalized)
+        return codes[0] if codes and len(codes) == 1 else None
+
+    def _edits(self, normalized: str) -> Iterator[str]:
+        # Everything one deletion, adjacent swap, substitution or insertion away
+        splits = [(normalized[:i], normalized[i:]) for i in range(len(normalized) + 1)]
+        for left, right in splits:
+            if right:
+                yield left + right[1:]
+            if len(right) > 1:
+                yield left + right[1] + right[0] + right[2:]
+        if len(self._alphabet) <= _MAX_EDIT_ALPHABET:
+            for left, right in splits:
+                for ch in self._alphabet:
+                    if right:
+                        yield left + ch + right[1:]
+                    yield left + ch + right
+
+    def _similar(self, normalized: str, limit: int) -> List[str]:
+        trigrams = self._trigrams_of(normalized)
+        postings = sorted((self._trigrams.get(trigram, ()) for trigram in trigrams), key=len)
+        shared: Counter = Counter()
+        for i, codes in enumerate(postings):
+            if i and len(codes) > _COMMON_TRIGRAM:
+                break
+            shared.update(codes)
+        # Jaccard similarity of the trigram sets; a code of length n has about n + 1 of them
+        scored = (
+            (count / (len(trigrams) + len(candidate) + 1 - count), candidate)
+            for candidate, count in shared.items()
+        )
+        return [candidate for score, candidate in heapq.nlargest(limit, scored) if score >= _MIN_SIMILARITY]
+
+    def suggest(self, code: str, limit: int) -> List[str]:
+        normalized = self.normalize(code)
+        if not self._plausible(normalized):
+            return []
+        # Insertion-ordered set: exact form (when ambiguous), then one-edit neighbours, then trigram matches
+        found: Dict[str, None] = {}
+        if normalized in self._codes:
+            found[normalized] = None
+        for candidate in self._edits(normalized):
+            if len(found) >= limit:
+                break
+            if candidate in self._codes:
+                found[candidate] = None
+        if len(found) < limit:
+            for candidate in self._similar(normalized, limit):
+                found[candidate] = None
+        suggestions = [original for key in found for original in self._codes[key]]
+        return suggestions[:limit]
+
+
+CatalogIndexes = Tuple[BloomFilter, PrefixIndex, TrigramIndex]
+
+
+# In-process view of the movies table: an LRU of hot records plus a Bloom filter
+# of every known code, so unknown codes are rejected without touching SQLite
+class MovieCatalog:
+    def __init__(self, cache_size: int, error_rate: float):
+        self.error_rate = error_rate
+        self._records = LRUCache(cache_size)
+        self._filter = BloomFilter(_FILTER_MIN_CAPACITY, error_rate)
+        self._prefixes = PrefixIndex()
+        self._trigrams = TrigramIndex()
+        # Bumped on every mutation so lookups racing a write don't cache stale rows
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.filtered = 0
+        self.false_positives = 0
+
+    def build_indexes(self, movies: Iterable[Tuple[str, Optional[str]]]) -> CatalogIndexes:
+        # Pure, so it can run on a database thread while the loop keeps serving the old indexes
+        movies = list(movies)
+        bloom = BloomFilter(max(len(movies) * _FILTER_HEADROOM, _FILTER_MIN_CAPACITY), self.error_rate)
+        for code, _ in movies:
+            bloom.add(code)
+        return bloom, PrefixIndex.build(movies), TrigramIndex.build(code for code, _ in movies)
+
+    def reset(self, indexes: CatalogIndexes) -> None:
+        self._filter, self._prefixes, self._trigrams = indexes
+        self._records.clear()
+        self.generation += 1
+
+    def get(self, code: str) -> Optional[Movie]:
+        record = self._records.get(code)
+        if record is not None:
+            self.hits += 1
+        return record
+
+    def might_contain(self, code: str) -> bool:
+        if code in self._filter:
+            return True
+        self.filtered += 1
+        return False
+
+    def remember(self, code: str, record: Optional[Movie], generation: int) -> None:
+        self.misses += 1
+        if record is None:
+            self.false_positives += 1
+        elif generation == self.generation:
+            self._records.set(code, record)
+
+    def add(self, record: Movie) -> None:
+        self._filter.add(record.code)
+        self._prefixes.add(record.code, record.name)
+        self._trigrams.add(record.code)
+        self._records.set(record.code, record)
+        self.generation += 1
+
+    def discard(self, code: str) -> None:
+        # Bloom filters can't delete; the stale bit only costs a false positive
+        self._records.pop(code)
+        self.generation += 1
+
+    def remove(self, code: str) -> None:
+        self._prefixes.remove(code)
+        self._trigrams.remove(code)
+        self.discard(code)
+
+    def refresh(self, code: str, record: Optional[Movie]) -> None:
+        # Applies another process's write. Only a new, deleted or renamed code touches the indexes;
+        # anything else (storage post, parts) just drops the cached record.
+        if record is None:
+            self.remove(code)
+        elif self._prefixes.indexed(code, record.name):
+            self.discard(code)
+        else:
+            self.add(record)
+
+    def prefix_search(self, prefix: str, limit: int, offset: int = 0) -> List[str]:
+        return self._prefixes.search(prefix, limit, offset)
+
+    def match_code(self, code: str) -> Optional[str]:
+        return self._trigrams.match(code)
+
+    def suggest_codes(self, code: str, limit: int) -> List[str]:
+        return self._trigrams.suggest(code, limit)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cached": len(self._records),
+            "hits": self.hits,
+            "misses": self.misses,
+            "filtered": self.filtered,
+            "false_positives": self.false_positives,
+        }
+
+
+catalog = MovieCatalog(cache_size=MOVIE_CACHE_SIZE, error_rate=MOVIE_FILTER_ERROR_RATE)
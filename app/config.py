@@ -1,15 +1,91 @@
 import os
-from typing import List, Set
+from typing import Dict, List, Set
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Base URL of a self-hosted Bot API server (or the benchmark's fake one); defaults to api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 ADMIN_IDS: Set[int] = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 CHANNELS: List[int] = [int(x) for x in os.getenv("CHANNELS", "").split(",") if x.strip()]
 STORAGE_CHANNEL_ID = int(os.getenv("STORAGE_CHANNEL_ID")) if os.getenv("STORAGE_CHANNEL_ID") else None
 DB_PATH = os.getenv("DB_PATH", "movies.db")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", os.path.join(os.path.dirname(DB_PATH), "fsm.db"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "1"))
+DB_READ_CONNECTIONS = int(os.getenv("DB_READ_CONNECTIONS", "4"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+MOVIE_CACHE_SIZE = int(os.getenv("MOVIE_CACHE_SIZE", "10000"))
+MOVIE_FILTER_ERROR_RATE = float(os.getenv("MOVIE_FILTER_ERROR_RATE", "0.01"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+# Close codes offered as buttons when a code is not found
+CODE_SUGGESTIONS = int(os.getenv("CODE_SUGGESTIONS", "5"))
+INLINE_RESULTS_LIMIT = int(os.getenv("INLINE_RESULTS_LIMIT", "20"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+JOIN_FLUSH_INTERVAL = float(os.getenv("JOIN_FLUSH_INTERVAL_MS", "200")) / 1000
+JOIN_FLUSH_SIZE = int(os.getenv("JOIN_FLUSH_SIZE", "500"))
+JOIN_REQUEST_MAX_AGE = float(os.getenv("JOIN_REQUEST_MAX_AGE", str(7 * 24 * 3600)))
+JOIN_RETENTION_INTERVAL = float(os.getenv("JOIN_RETENTION_INTERVAL", "3600"))
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+MEMBERSHIP_CHECK_TIMEOUT = float(os.getenv("MEMBERSHIP_CHECK_TIMEOUT", "5"))
+# Repeats of the same button press by the same user within this many seconds are ignored
+CALLBACK_DEBOUNCE = float(os.getenv("CALLBACK_DEBOUNCE", "2"))
+# Per-user anti-flood: sustained updates per second, burst size, seconds between warnings
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "5"))
+FLOOD_WARN_INTERVAL = float(os.getenv("FLOOD_WARN_INTERVAL", "30"))
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "100000"))
+# Inline queries arrive on nearly every keystroke, so they get their own, larger bucket
+FLOOD_INLINE_RATE = float(os.getenv("FLOOD_INLINE_RATE", "5"))
+FLOOD_INLINE_BURST = float(os.getenv("FLOOD_INLINE_BURST", "20"))
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "15"))
+# A broadcast whose process stops renewing this lease is resumed by another (or the next) process
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "60"))
+# Same for the storage-channel phase of /import
+IMPORT_LEASE = float(os.getenv("IMPORT_LEASE", "60"))
+# Per-code request counters are kept in memory and written to movie_stats this often; codes
+# beyond STATS_MAX_CODES distinct ones per flush are counted together as "other"
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "60"))
+STATS_MAX_CODES = int(os.getenv("STATS_MAX_CODES", "20000"))
+# Polling: updates processed at once, queued before fetching pauses, and per-type caps
+# ("chat_join_request=8,chat_member=4"); on shutdown, seconds to wait for queued updates
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_TYPE_LIMITS: Dict[str, int] = {
+    name.strip(): int(limit)
+    for name, _, limit in (
+        item.partition("=")
+        for item in os.getenv("UPDATE_TYPE_LIMITS", "chat_join_request=16,chat_member=4,my_chat_member=4").split(",")
+    )
+    if name.strip()
+}
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "30"))
+# Online backups of DB_PATH into BACKUP_DIR every BACKUP_INTERVAL seconds (0 disables), keeping
+# the newest BACKUP_KEEP; copied BACKUP_STEP_PAGES pages at a time with a pause between steps
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "86400"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "256"))
+BACKUP_STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.01"))
+# Prometheus /metrics listener; worker N of a multi-worker setup uses METRICS_PORT + N, 0 disables
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
 
 def validate_config():
@@ -17,4 +93,16 @@ def validate_config():
         raise RuntimeError("BOT_TOKEN is required")
     if STORAGE_CHANNEL_ID is None:
         raise RuntimeError("STORAGE_CHANNEL_ID is required")
+    if BOT_MODE not in {"polling", "webhook"}:
+        raise RuntimeError("BOT_MODE must be 'polling' or 'webhook'")
+    if FSM_STORAGE not in {"memory", "sqlite"}:
+        raise RuntimeError("FSM_STORAGE must be 'memory' or 'sqlite'")
+    if WORKERS > 1 and FSM_STORAGE != "sqlite":
+        raise RuntimeError("Multi-worker mode requires FSM_STORAGE=sqlite")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    if UPDATE_CONCURRENCY < 1 or UPDATE_QUEUE_SIZE < 1 or any(limit < 1 for limit in UPDATE_TYPE_LIMITS.values()):
+        raise RuntimeError("UPDATE_CONCURRENCY, UPDATE_QUEUE_SIZE and UPDATE_TYPE_LIMITS must be at least 1")
+    if FLOOD_RATE <= 0 or FLOOD_BURST < 1 or FLOOD_INLINE_RATE <= 0 or FLOOD_INLINE_BURST < 1:
+        raise RuntimeError("FLOOD_*RATE must be positive and FLOOD_*BURST at least 1")
 
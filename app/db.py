@@ -1,7 +1,31 @@
+import asyncio
+import functools
+import gzip
+import json
+import logging
+import os
+import re
 import sqlite3
-from typing import List, NamedTuple, Optional, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
 
-from app.config import DB_PATH
+from app.catalog import CatalogIndexes, Movie, catalog
+from app.config import (
+    BACKUP_STEP_PAGES,
+    BACKUP_STEP_PAUSE,
+    DB_CACHE_SIZE_KB,
+    DB_PATH,
+    DB_READ_CONNECTIONS,
+    JOIN_FLUSH_INTERVAL,
+    JOIN_FLUSH_SIZE,
+    STATS_MAX_CODES,
+)
+from app.formatting import render_captions
+from app.metrics import db_duration, db_queue_wait
+from app.singleflight import SingleFlight
 
 
 class Channel(NamedTuple):
@@ -9,8 +33,19 @@ class Channel(NamedTuple):
     chat_id: int
 
 
-def _get_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+def _configure(conn: sqlite3.Connection) -> None:
+    conn.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL only syncs at checkpoints, so per-write commits stay cheap
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
+
+
+# Schema migrations
+
+def _legacy_schema(conn: sqlite3.Connection) -> None:
+    # Brings any database created before versioning (user_version 0) up to date; idempotent
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS movies (
@@ -67,99 +102,1355 @@ def _get_connection() -> sqlite3.Connection:
             );
             """
         )
-    conn.commit()
+    # Supports the retention job that expires stale pending requests
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_join_requests_requested_at ON join_requests (requested_at)")
+    # Full-text index over titles, kept in sync with movies by triggers
+    has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movies_fts'").fetchone()
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts USING fts5(
+            name,
+            description,
+            content='movies',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS movies_fts_insert AFTER INSERT ON movies BEGIN
+            INSERT INTO movies_fts (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS movies_fts_delete AFTER DELETE ON movies BEGIN
+            INSERT INTO movies_fts (movies_fts, rowid, name, description)
+            VALUES ('delete', old.rowid, old.name, old.description);
+        END;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS movies_fts_update AFTER UPDATE OF name, description ON movies BEGIN
+            INSERT INTO movies_fts (movies_fts, rowid, name, description)
+            VALUES ('delete', old.rowid, old.name, old.description);
+            INSERT INTO movies_fts (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+        END;
+        """
+    )
+    if not has_fts:
+        conn.execute("INSERT INTO movies_fts (movies_fts) VALUES ('rebuild')")
+    # Bumped by triggers so other processes sharing the file can tell when their caches are stale
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    conn.execute("INSERT OR IGNORE INTO data_versions (name) VALUES ('movies'), ('channels')")
+    for table in ("movies", "channels"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+                END;
+                """
+            )
+
+
+def _add_rendered_captions(conn: sqlite3.Connection) -> None:
+    conn.execute("ALTER TABLE movies ADD COLUMN caption TEXT NOT NULL DEFAULT ''")
+    conn.execute("ALTER TABLE movies ADD COLUMN storage_caption TEXT NOT NULL DEFAULT ''")
+    rows = conn.execute("SELECT code, name, description FROM movies").fetchall()
+    conn.executemany(
+        "UPDATE movies SET caption = ?, storage_caption = ? WHERE code = ?",
+        [(*render_captions(code, name, description), code) for code, name, description in rows],
+    )
+
+
+def _add_users_and_broadcasts(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            first_seen INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL
+        );
+        """
+    )
+    # One row per broadcast; last_user_id is the keyset checkpoint, lease_until marks the
+    # process currently sending it so another one can take over after a crash
+    conn.execute(
+        """
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            lease_until INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+        );
+        """
+    )
+
+
+def _add_movie_stats(conn: sqlite3.Connection) -> None:
+    # Hour-bucketed counters; the (hour, code) key makes every time-window query a range scan
+    conn.execute(
+        """
+        CREATE TABLE movie_stats (
+            hour INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, code)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+def _add_movie_parts(conn: sqlite3.Connection) -> None:
+    # Parts after the first of a multi-part title; part 1 stays in movies.file_id
+    conn.execute(
+        """
+        CREATE TABLE movie_parts (
+            code TEXT NOT NULL REFERENCES movies(code),
+            part INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (code, part)
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute(
+        """
+        CREATE TRIGGER movie_parts_delete AFTER DELETE ON movies BEGIN
+            DELETE FROM movie_parts WHERE code = old.code;
+        END;
+        """
+    )
+
+
+def _add_part_storage_messages(conn: sqlite3.Connection) -> None:
+    # Each part's post in the storage channel, so deleting a title removes the whole album
+    conn.execute("ALTER TABLE movie_parts ADD COLUMN storage_message_id INTEGER")
+    # Parts are part of a movie's cached record, so other processes must see their changes too
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"""
+            CREATE TRIGGER movie_parts_version_{event.lower()} AFTER {event} ON movie_parts
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = 'movies';
+            END;
+            """
+        )
+
+
+def _add_movie_changes(conn: sqlite3.Connection) -> None:
+    # Codes touched by any write, in order, so other processes patch their catalog per code
+    # instead of rebuilding it; db.sync_external_changes prunes old rows
+    conn.execute(
+        """
+        CREATE TABLE movie_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT NOT NULL
+        );
+        """
+    )
+    for table in ("movies", "movie_parts"):
+        conn.execute(
+            f"""
+            CREATE TRIGGER {table}_changes_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO movie_changes (code) VALUES (new.code);
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER {table}_changes_update AFTER UPDATE ON {table} BEGIN
+                INSERT INTO movie_changes (code) VALUES (new.code);
+                INSERT INTO movie_changes (code) SELECT old.code WHERE old.code <> new.code;
+            END;
+            """
+        )
+        conn.execute(
+            f"""
+            CREATE TRIGGER {table}_changes_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO movie_changes (code) VALUES (old.code);
+            END;
+            """
+        )
+
+
+def _add_imports(conn: sqlite3.Connection) -> None:
+    # One row per /import whose storage-channel phase is still running; lease_until works like
+    # broadcasts'. import_rows holds its rows still to be posted, or (file_id NULL) still to be
+    # resolved from storage_message_id; each is deleted once handled.
+    conn.execute(
+        """
+        CREATE TABLE imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            posted INTEGER NOT NULL DEFAULT 0,
+            problems TEXT NOT NULL DEFAULT '[]',
+            problem_count INTEGER NOT NULL DEFAULT 0,
+            lease_until INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE import_rows (
+            import_id INTEGER NOT NULL REFERENCES imports(id),
+            code TEXT NOT NULL,
+            file_id TEXT,
+            storage_message_id INTEGER,
+            name TEXT NOT NULL,
+            description TEXT NOT NULL,
+            PRIMARY KEY (import_id, code)
+        ) WITHOUT ROWID;
+        """
+    )
+
+
+# Migration N brings the schema to user_version N. Append only; never edit a released one.
+_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _legacy_schema,
+    _add_rendered_captions,
+    _add_users_and_broadcasts,
+    _add_movie_stats,
+    _add_movie_parts,
+    _add_part_storage_messages,
+    _add_movie_changes,
+    _add_imports,
+]
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(_MIGRATIONS):
+        return
+    # IMMEDIATE takes the write lock up front, so workers starting together migrate one at a time
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number in range(version + 1, len(_MIGRATIONS) + 1):
+            started = time.perf_counter()
+            _MIGRATIONS[number - 1](conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            logging.info("Applied database migration %s in %.1f ms", number, (time.perf_counter() - started) * 1000)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+# All writes go through a single thread owning _conn; reads use per-thread connections.
+# Nothing touches the file until the first query, so importing this module is free.
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_CONNECTIONS, thread_name_prefix="db-reader")
+_local = threading.local()
+
+
+def _write_connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+                _configure(conn)
+                _migrate(conn)
+                _conn = conn
+    return _conn
+
+
+def _read_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # Readers must not see the file before migrations have run
+        _write_connection()
+        conn = sqlite3.connect(DB_PATH)
+        _configure(conn)
+        conn.execute("PRAGMA query_only=ON")
+        _local.conn = conn
     return conn
 
 
-_conn = _get_connection()
+def _reader(func):
+    name = func.__name__.lstrip("_")
+
+    def run(submitted, *args, **kwargs):
+        started = time.perf_counter()
+        db_queue_wait.observe(started - submitted, "reader")
+        try:
+            return func(_read_connection(), *args, **kwargs)
+        finally:
+            db_duration.observe(time.perf_counter() - started, name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        call = functools.partial(run, time.perf_counter(), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_read_executor, call)
+
+    return wrapper
+
+
+def _writer(func):
+    name = func.__name__.lstrip("_")
+
+    def run(submitted, *args, **kwargs):
+        started = time.perf_counter()
+        db_queue_wait.observe(started - submitted, "writer")
+        try:
+            conn = _write_connection()
+            with conn:
+                return func(conn, *args, **kwargs)
+        finally:
+            db_duration.observe(time.perf_counter() - started, name)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        call = functools.partial(run, time.perf_counter(), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_write_executor, call)
+
+    return wrapper
 
 
 # Movies
 
-def save_movie(code: str, file_id: str, storage_message_id: Optional[int], name: str, description: str) -> bool:
+_MOVIE_COLUMNS = "code, file_id, storage_message_id, name, description, caption, storage_caption"
+_INSERT_MOVIE = (
+    f"INSERT INTO movies ({_MOVIE_COLUMNS}) "
+    "VALUES (:code, :file_id, :storage_message_id, :name, :description, :caption, :storage_caption)"
+)
+
+
+def _new_movie(
+    code: str,
+    file_id: str,
+    storage_message_id: Optional[int],
+    name: str,
+    description: str,
+    extra_file_ids: Sequence[str] = (),
+) -> Movie:
+    captions = render_captions(code, name, description)
+    return Movie(code, file_id, storage_message_id, name, description, *captions, tuple(extra_file_ids))
+
+
+def _with_parts(conn: sqlite3.Connection, rows: List[tuple]) -> List[Movie]:
+    # One indexed range read for the parts of every row
+    if not rows:
+        return []
+    codes = [row[0] for row in rows]
+    placeholders = ",".join("?" * len(codes))
+    parts: Dict[str, List[str]] = {}
+    query = f"SELECT code, file_id FROM movie_parts WHERE code IN ({placeholders}) ORDER BY code, part"
+    for code, file_id in conn.execute(query, codes):
+        parts.setdefault(code, []).append(file_id)
+    return [Movie._make((*row, tuple(parts.get(row[0], ())))) for row in rows]
+
+
+_INSERT_PART = "INSERT INTO movie_parts (code, part, file_id, storage_message_id) VALUES (?, ?, ?, ?)"
+
+
+@_writer
+def _insert_movie(conn: sqlite3.Connection, movie: Movie, part_message_ids: Sequence[Optional[int]]) -> bool:
     try:
-        _conn.execute(
-            "INSERT INTO movies (code, file_id, storage_message_id, name, description) VALUES (?, ?, ?, ?, ?)",
-            (code, file_id, storage_message_id, name, description),
-        )
-        _conn.commit()
-        return True
+        conn.execute(_INSERT_MOVIE, movie._asdict())
     except sqlite3.IntegrityError:
         return False
+    parts = zip_longest(movie.extra_file_ids, part_message_ids[:len(movie.extra_file_ids)])
+    conn.executemany(
+        _INSERT_PART,
+        [(movie.code, part, file_id, message_id) for part, (file_id, message_id) in enumerate(parts, start=2)],
+    )
+    return True
 
 
-def get_movie_record(code: str) -> Optional[Tuple[str, str, Optional[int], Optional[str], Optional[str]]]:
-    return _conn.execute(
-        "SELECT code, file_id, storage_message_id, name, description FROM movies WHERE code = ?",
-        (code,),
-    ).fetchone()
+async def save_movie(
+    code: str,
+    file_id: str,
+    storage_message_id: Optional[int],
+    name: str,
+    description: str,
+    extra_file_ids: Sequence[str] = (),
+    extra_storage_message_ids: Sequence[Optional[int]] = (),
+) -> bool:
+    movie = _new_movie(code, file_id, storage_message_id, name, description, extra_file_ids)
+    saved = await _insert_movie(movie, extra_storage_message_ids)
+    if saved:
+        catalog.add(movie)
+    return saved
+
+
+@_reader
+def _select_movie(conn: sqlite3.Connection, code: str) -> Optional[Movie]:
+    rows = conn.execute(f"SELECT {_MOVIE_COLUMNS} FROM movies WHERE code = ?", (code,)).fetchall()
+    movies = _with_parts(conn, rows)
+    return movies[0] if movies else None
+
+
+# Concurrent lookups of the same uncached code share one query
+movie_lookups = SingleFlight()
+
+
+async def _lookup_movie(code: str) -> Tuple[int, Optional[Movie]]:
+    # The generation is taken when the query starts, not when a caller joins it
+    generation = catalog.generation
+    return generation, await _select_movie(code)
+
+
+async def get_movie_record(code: str) -> Optional[Movie]:
+    if not _initialized:
+        await init()
+    record = catalog.get(code)
+    if record is not None:
+        return record
+    if not catalog.might_contain(code):
+        return None
+    generation, record = await movie_lookups.do(code, lambda: _lookup_movie(code))
+    catalog.remember(code, record, generation)
+    return record
 
 
-def remove_movie(code: str) -> bool:
-    cur = _conn.execute("DELETE FROM movies WHERE code = ?", (code,))
-    _conn.commit()
+@_writer
+def _delete_movie(conn: sqlite3.Connection, code: str) -> bool:
+    cur = conn.execute("DELETE FROM movies WHERE code = ?", (code,))
     return cur.rowcount > 0
 
 
+async def remove_movie(code: str) -> bool:
+    removed = await _delete_movie(code)
+    catalog.remove(code)
+    return removed
+
+
+@_reader
+def part_storage_message_ids(conn: sqlite3.Connection, code: str) -> List[int]:
+    rows = conn.execute(
+        "SELECT storage_message_id FROM movie_parts WHERE code = ? AND storage_message_id IS NOT NULL ORDER BY part",
+        (code,),
+    )
+    return [message_id for (message_id,) in rows]
+
+
+@_reader
+def _select_movies(conn: sqlite3.Connection, codes: List[str]) -> List[Movie]:
+    placeholders = ",".join("?" * len(codes))
+    rows = conn.execute(f"SELECT {_MOVIE_COLUMNS} FROM movies WHERE code IN ({placeholders})", codes).fetchall()
+    return _with_parts(conn, rows)
+
+
+async def get_movie_records(codes: Iterable[str]) -> Dict[str, Movie]:
+    records: Dict[str, Movie] = {}
+    missing: List[str] = []
+    for code in codes:
+        record = catalog.get(code)
+        if record is not None:
+            records[code] = record
+        else:
+            missing.append(code)
+    if missing:
+        generation = catalog.generation
+        for record in await _select_movies(missing):
+            catalog.remember(record.code, record, generation)
+            records[record.code] = record
+    return records
+
+
+_IMPORT_BATCH = 500
+
+
+def _insert_movie_rows(conn: sqlite3.Connection, rows: List[Movie]) -> List[str]:
+    # Existing codes are reported instead of overwritten
+    conflicts: List[str] = []
+    for start in range(0, len(rows), _IMPORT_BATCH):
+        batch = rows[start:start + _IMPORT_BATCH]
+        codes = [row.code for row in batch]
+        placeholders = ",".join("?" * len(codes))
+        existing = {code for (code,) in conn.execute(f"SELECT code FROM movies WHERE code IN ({placeholders})", codes)}
+        conflicts.extend(code for code in codes if code in existing)
+        conn.executemany(_INSERT_MOVIE, [row._asdict() for row in batch if row.code not in existing])
+    return conflicts
+
+
+@_writer
+def _insert_movies(conn: sqlite3.Connection, rows: List[Movie]) -> List[str]:
+    # One transaction for the whole import
+    return _insert_movie_rows(conn, rows)
+
+
+async def import_movies(rows: Iterable[Tuple[str, str, Optional[int], str, str]]) -> List[str]:
+    rows = [_new_movie(*row) for row in rows]
+    conflicts = await _insert_movies(rows)
+    if len(conflicts) < len(rows):
+        # Rebuild rather than grow the filter past the capacity it was sized for
+        await reload_catalog()
+    return conflicts
+
+
+@_writer
+def _insert_movie_parts(
+    conn: sqlite3.Connection, parts: List[Tuple[str, int, str, Optional[int]]]
+) -> Tuple[List[str], List[Tuple[str, int]]]:
+    # Parts only attach to movies that exist; like movies, existing parts are reported, not overwritten
+    unknown: List[str] = []
+    conflicts: List[Tuple[str, int]] = []
+    for start in range(0, len(parts), _IMPORT_BATCH):
+        batch = parts[start:start + _IMPORT_BATCH]
+        codes = sorted({part[0] for part in batch})
+        placeholders = ",".join("?" * len(codes))
+        known = {code for (code,) in conn.execute(f"SELECT code FROM movies WHERE code IN ({placeholders})", codes)}
+        existing = set(
+            conn.execute(f"SELECT code, part FROM movie_parts WHERE code IN ({placeholders})", codes).fetchall()
+        )
+        rows = []
+        for part in batch:
+            if part[0] not in known:
+                unknown.append(part[0])
+            elif part[:2] in existing:
+                conflicts.append(part[:2])
+            else:
+                rows.append(part)
+        conn.executemany(_INSERT_PART, rows)
+    return unknown, conflicts
+
+
+async def import_movie_parts(
+    parts: Iterable[Tuple[str, int, str, Optional[int]]]
+) -> Tuple[List[str], List[Tuple[str, int]]]:
+    parts = [tuple(part) for part in parts]
+    unknown, conflicts = await _insert_movie_parts(parts)
+    # Cached records were loaded without these parts
+    for code in {part[0] for part in parts}:
+        catalog.discard(code)
+    return unknown, conflicts
+
+
+def _fts_query(text: str) -> Optional[str]:
+    # Quote each word so user input can't inject FTS syntax; every word matches as a prefix
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+@_reader
+def _search_movies(conn: sqlite3.Connection, query: str, limit: int, offset: int) -> List[Tuple[str, str]]:
+    return conn.execute(
+        """
+        SELECT movies.code, movies.name FROM movies_fts
+        JOIN movies ON movies.rowid = movies_fts.rowid
+        WHERE movies_fts MATCH ?
+        ORDER BY bm25(movies_fts, 10.0, 1.0)
+        LIMIT ? OFFSET ?
+        """,
+        (query, limit, offset),
+    ).fetchall()
+
+
+async def search_movies(text: str, limit: int, offset: int = 0) -> List[Tuple[str, str]]:
+    query = _fts_query(text)
+    if query is None:
+        return []
+    return await _search_movies(query, limit, offset)
+
+
 # Channels
 
-def add_channel(invite_link: str, chat_id: int) -> bool:
+# Snapshot of the channels table, invalidated only by the channel writers below
+_channels: Optional[Tuple[Channel, ...]] = None
+_channels_version = 0
+
+
+def channels_version() -> int:
+    return _channels_version
+
+
+def _invalidate_channels() -> None:
+    global _channels, _channels_version
+    _channels = None
+    _channels_version += 1
+
+
+@_writer
+def _insert_channel(conn: sqlite3.Connection, invite_link: str, chat_id: int) -> bool:
     try:
-        _conn.execute("INSERT INTO channels (invite_link, chat_id) VALUES (?, ?)", (invite_link, chat_id))
-        _conn.commit()
+        conn.execute("INSERT INTO channels (invite_link, chat_id) VALUES (?, ?)", (invite_link, chat_id))
         return True
     except sqlite3.IntegrityError:
         return False
 
 
-def update_channel_invite(old_invite_link: str, new_invite_link: str) -> bool:
-    cur = _conn.execute("UPDATE channels SET invite_link = ? WHERE invite_link = ?", (new_invite_link, old_invite_link))
-    _conn.commit()
+async def add_channel(invite_link: str, chat_id: int) -> bool:
+    created = await _insert_channel(invite_link, chat_id)
+    if created:
+        _invalidate_channels()
+    return created
+
+
+@_writer
+def _update_channel_invite(conn: sqlite3.Connection, old_invite_link: str, new_invite_link: str) -> bool:
+    cur = conn.execute("UPDATE channels SET invite_link = ? WHERE invite_link = ?", (new_invite_link, old_invite_link))
     return cur.rowcount > 0
 
 
-def get_channel(invite_link: str) -> Optional[Channel]:
-    row = _conn.execute("SELECT invite_link, chat_id FROM channels WHERE invite_link = ?", (invite_link,)).fetchone()
+async def update_channel_invite(old_invite_link: str, new_invite_link: str) -> bool:
+    updated = await _update_channel_invite(old_invite_link, new_invite_link)
+    if updated:
+        _invalidate_channels()
+    return updated
+
+
+@_reader
+def get_channel(conn: sqlite3.Connection, invite_link: str) -> Optional[Channel]:
+    row = conn.execute("SELECT invite_link, chat_id FROM channels WHERE invite_link = ?", (invite_link,)).fetchone()
     return Channel(*row) if row else None
 
 
-def get_channel_by_chat_id(chat_id: int) -> Optional[Channel]:
-    row = _conn.execute("SELECT invite_link, chat_id FROM channels WHERE chat_id = ?", (chat_id,)).fetchone()
+@_reader
+def get_channel_by_chat_id(conn: sqlite3.Connection, chat_id: int) -> Optional[Channel]:
+    row = conn.execute("SELECT invite_link, chat_id FROM channels WHERE chat_id = ?", (chat_id,)).fetchone()
     return Channel(*row) if row else None
 
 
-def list_channels() -> List[Channel]:
-    rows = _conn.execute("SELECT invite_link, chat_id FROM channels ORDER BY rowid").fetchall()
-    return [Channel(*row) for row in rows]
+@_reader
+def _select_channels(conn: sqlite3.Connection) -> Tuple[Channel, ...]:
+    rows = conn.execute("SELECT invite_link, chat_id FROM channels ORDER BY rowid").fetchall()
+    return tuple(Channel(*row) for row in rows)
+
+
+async def list_channels() -> Tuple[Channel, ...]:
+    global _channels
+    if _channels is not None:
+        return _channels
+    version = _channels_version
+    channels = await _select_channels()
+    # Don't publish a snapshot that a concurrent write already made stale
+    if version == _channels_version:
+        _channels = channels
+    return channels
 
 
-def remove_channel(invite_link: str) -> bool:
-    cur = _conn.execute("DELETE FROM channels WHERE invite_link = ?", (invite_link,))
-    _conn.commit()
+@_writer
+def _delete_channel(conn: sqlite3.Connection, invite_link: str) -> bool:
+    cur = conn.execute("DELETE FROM channels WHERE invite_link = ?", (invite_link,))
     return cur.rowcount > 0
 
 
+async def remove_channel(invite_link: str) -> bool:
+    removed = await _delete_channel(invite_link)
+    if removed:
+        _invalidate_channels()
+    return removed
+
+
+# Cross-process cache coherence
+
+_seen_versions: Dict[str, int] = {}
+# Last movie_changes row applied to this process's catalog
+_seen_change = 0
+# Past this many changed codes one rebuild is cheaper than patching the indexes code by code
+_MAX_PATCHED_CODES = 1000
+_CHANGE_LOG_KEEP = 10000
+
+
+@_reader
+def _select_versions(conn: sqlite3.Connection) -> Dict[str, int]:
+    return dict(conn.execute("SELECT name, version FROM data_versions").fetchall())
+
+
+@_reader
+def _select_movie_changes(conn: sqlite3.Connection, after: int) -> Tuple[int, int, List[str]]:
+    # (oldest kept row, latest row, codes changed after `after`) from one snapshot
+    conn.execute("BEGIN")
+    try:
+        oldest, latest = conn.execute("SELECT MIN(seq), MAX(seq) FROM movie_changes").fetchone()
+        rows = conn.execute(
+            "SELECT DISTINCT code FROM movie_changes WHERE seq > ? LIMIT ?", (after, _MAX_PATCHED_CODES + 1)
+        )
+        codes = [code for (code,) in rows]
+    finally:
+        conn.rollback()
+    return oldest or 0, latest or 0, codes
+
+
+@_writer
+def _prune_movie_changes(conn: sqlite3.Connection, before: int) -> None:
+    conn.execute("DELETE FROM movie_changes WHERE seq < ?", (before,))
+
+
+@_reader
+def _load_catalog_indexes(conn: sqlite3.Connection) -> CatalogIndexes:
+    return catalog.build_indexes(conn.execute("SELECT code, name FROM movies"))
+
+
+async def reload_catalog() -> None:
+    while True:
+        generation = catalog.generation
+        indexes = await _load_catalog_indexes()
+        # A local write landed while the indexes were building; its code may be missing
+        if generation == catalog.generation:
+            catalog.reset(indexes)
+            return
+
+
+async def _apply_movie_changes() -> None:
+    global _seen_change
+    while True:
+        oldest, latest, codes = await _select_movie_changes(_seen_change)
+        if latest <= _seen_change:
+            return
+        # Rows we haven't seen were pruned, or too much changed to patch
+        if oldest > _seen_change + 1 or len(codes) > _MAX_PATCHED_CODES:
+            await reload_catalog()
+            break
+        generation = catalog.generation
+        records = {record.code: record for record in await _select_movies(codes)}
+        # A local write landed meanwhile; the rows just read may be older than what it cached
+        if generation != catalog.generation:
+            continue
+        # Our own writes come back here too; re-applying them is harmless
+        for code in codes:
+            catalog.refresh(code, records.get(code))
+        break
+    _seen_change = latest
+    if latest - oldest > 2 * _CHANGE_LOG_KEEP:
+        await _prune_movie_changes(latest - _CHANGE_LOG_KEEP)
+
+
+async def sync_external_changes() -> None:
+    # Only needed when several processes share the database (multi-worker mode)
+    versions = await _select_versions()
+    if versions.get("channels") != _seen_versions.get("channels"):
+        _invalidate_channels()
+    _seen_versions.update(versions)
+    await _apply_movie_changes()
+
+
+# Startup
+
+_initialized = False
+_init_lock = asyncio.Lock()
+
+
+async def init() -> None:
+    # Opens (and if needed migrates) the database and loads the movie catalog. Runs as a startup
+    # hook; lookups that depend on the catalog call it too, in case they come first.
+    global _initialized, _seen_change
+    if _initialized:
+        return
+    async with _init_lock:
+        if _initialized:
+            return
+        started = time.perf_counter()
+        versions = await _select_versions()
+        # Read first, so changes made while the catalog loads are applied by the next sync
+        _, latest, _ = await _select_movie_changes(0)
+        await reload_catalog()
+        _seen_versions.update(versions)
+        _seen_change = latest
+        _initialized = True
+        logging.info("Database ready in %.1f ms", (time.perf_counter() - started) * 1000)
+
+
 # Join Requests
 
-def upsert_join_request(user_id: int, chat_id: int, status: str = "pending") -> None:
-    _conn.execute(
+# Write-behind buffer: (user_id, chat_id) -> (status, requested_at), or None for a delete.
+# Bursts of join/leave events collapse to one row change each and flush in one transaction.
+_JoinChange = Optional[Tuple[str, int]]
+_join_buffer: Dict[Tuple[int, int], _JoinChange] = {}
+_join_flushing: List[Dict[Tuple[int, int], _JoinChange]] = []
+_join_flush_timer: Optional[asyncio.TimerHandle] = None
+_join_flush_tasks: Set[asyncio.Task] = set()
+
+
+@_writer
+def _write_join_requests(
+    conn: sqlite3.Connection,
+    upserts: List[Tuple[int, int, str, int]],
+    deletes: List[Tuple[int, int]],
+) -> None:
+    if deletes:
+        conn.executemany("DELETE FROM join_requests WHERE user_id = ? AND chat_id = ?", deletes)
+    if upserts:
+        conn.executemany(
+            """
+            INSERT INTO join_requests (user_id, chat_id, status, requested_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, chat_id) DO UPDATE SET status=excluded.status, requested_at=excluded.requested_at
+            """,
+            upserts,
+        )
+
+
+async def flush_join_requests() -> None:
+    global _join_flush_timer
+    if _join_flush_timer is not None:
+        _join_flush_timer.cancel()
+        _join_flush_timer = None
+    if not _join_buffer:
+        return
+    batch = dict(_join_buffer)
+    _join_buffer.clear()
+    # Stays visible to readers until it is committed
+    _join_flushing.append(batch)
+    upserts = [(user_id, chat_id, *change) for (user_id, chat_id), change in batch.items() if change is not None]
+    deletes = [key for key, change in batch.items() if change is None]
+    try:
+        await _write_join_requests(upserts, deletes)
+    except Exception as e:  # noqa
+        logging.error(e)
+        # Keep anything that hasn't been superseded for the next flush
+        for key, change in batch.items():
+            _join_buffer.setdefault(key, change)
+        # Retry on schedule rather than waiting for the next join event
+        if _join_flush_timer is None:
+            _join_flush_timer = asyncio.get_running_loop().call_later(JOIN_FLUSH_INTERVAL, _start_join_flush)
+    finally:
+        _join_flushing.remove(batch)
+
+
+def _start_join_flush() -> None:
+    global _join_flush_timer
+    _join_flush_timer = None
+    task = asyncio.create_task(flush_join_requests())
+    _join_flush_tasks.add(task)
+    task.add_done_callback(_join_flush_tasks.discard)
+
+
+def _buffer_join_change(user_id: int, chat_id: int, change: _JoinChange) -> None:
+    global _join_flush_timer
+    _join_buffer[(user_id, chat_id)] = change
+    if len(_join_buffer) >= JOIN_FLUSH_SIZE:
+        if _join_flush_timer is not None:
+            _join_flush_timer.cancel()
+        _start_join_flush()
+    elif _join_flush_timer is None:
+        _join_flush_timer = asyncio.get_running_loop().call_later(JOIN_FLUSH_INTERVAL, _start_join_flush)
+
+
+def _buffered_join_change(user_id: int, chat_id: int) -> Tuple[bool, _JoinChange]:
+    key = (user_id, chat_id)
+    if key in _join_buffer:
+        return True, _join_buffer[key]
+    for batch in reversed(_join_flushing):
+        if key in batch:
+            return True, batch[key]
+    return False, None
+
+
+async def upsert_join_request(user_id: int, chat_id: int, status: str = "pending") -> None:
+    _buffer_join_change(user_id, chat_id, (status, int(time.time())))
+
+
+async def remove_join_request(user_id: int, chat_id: int) -> None:
+    _buffer_join_change(user_id, chat_id, None)
+
+
+async def has_pending_join_request(user_id: int, chat_id: int) -> bool:
+    return chat_id in await pending_join_requests(user_id, [chat_id])
+
+
+@_reader
+def _select_pending_join_requests(conn: sqlite3.Connection, user_id: int, chat_ids: List[int]) -> Set[int]:
+    placeholders = ",".join("?" * len(chat_ids))
+    rows = conn.execute(
+        f"SELECT chat_id FROM join_requests WHERE user_id = ? AND status = 'pending' AND chat_id IN ({placeholders})",
+        (user_id, *chat_ids),
+    ).fetchall()
+    return {row[0] for row in rows}
+
+
+async def pending_join_requests(user_id: int, chat_ids: Iterable[int]) -> Set[int]:
+    pending: Set[int] = set()
+    unbuffered: List[int] = []
+    for chat_id in chat_ids:
+        buffered, change = _buffered_join_change(user_id, chat_id)
+        if not buffered:
+            unbuffered.append(chat_id)
+        elif change is not None and change[0] == "pending":
+            pending.add(chat_id)
+    if unbuffered:
+        pending |= await _select_pending_join_requests(user_id, unbuffered)
+    return pending
+
+
+_RETENTION_BATCH = 1000
+
+
+@_writer
+def _delete_expired_join_requests(conn: sqlite3.Connection, cutoff: int) -> int:
+    cur = conn.execute(
+        """
+        DELETE FROM join_requests WHERE rowid IN (
+            SELECT rowid FROM join_requests WHERE requested_at < ? AND status = 'pending' LIMIT ?
+        )
+        """,
+        (cutoff, _RETENTION_BATCH),
+    )
+    return cur.rowcount
+
+
+async def expire_join_requests(max_age: float) -> int:
+    # Small batches keep each write transaction short while a large backlog drains
+    cutoff = int(time.time() - max_age)
+    total = 0
+    while True:
+        deleted = await _delete_expired_join_requests(cutoff)
+        total += deleted
+        if deleted < _RETENTION_BATCH:
+            return total
+
+
+# Users
+
+# Write-behind: user_id -> last seen timestamp, flushed periodically in one transaction
+_seen_users: Dict[int, int] = {}
+
+
+def touch_user(user_id: int) -> None:
+    _seen_users[user_id] = int(time.time())
+
+
+@_writer
+def _write_users(conn: sqlite3.Connection, rows: List[Tuple[int, int]]) -> None:
+    conn.executemany(
+        """
+        INSERT INTO users (user_id, first_seen, last_seen) VALUES (?1, ?2, ?2)
+        ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen
+        """,
+        rows,
+    )
+
+
+async def flush_users() -> None:
+    if not _seen_users:
+        return
+    batch = dict(_seen_users)
+    _seen_users.clear()
+    try:
+        await _write_users(list(batch.items()))
+    except BaseException:
+        # Keep whichever timestamp is newer and retry on the next flush
+        for user_id, seen in batch.items():
+            _seen_users[user_id] = max(seen, _seen_users.get(user_id, 0))
+        raise
+
+
+@_reader
+def count_users(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+
+@_reader
+def users_after(conn: sqlite3.Connection, user_id: int, limit: int) -> List[int]:
+    # Keyset pagination: cost stays flat however deep into the table we are
+    rows = conn.execute("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (user_id, limit))
+    return [user_id for (user_id,) in rows]
+
+
+@_writer
+def remove_users(conn: sqlite3.Connection, user_ids: List[int]) -> None:
+    conn.executemany("DELETE FROM users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+
+# Broadcasts
+
+class Broadcast(NamedTuple):
+    id: int
+    admin_chat_id: int
+    from_chat_id: int
+    message_id: int
+    total: int
+    last_user_id: int
+    sent: int
+    failed: int
+    blocked: int
+
+
+_BROADCAST_COLUMNS = "id, admin_chat_id, from_chat_id, message_id, total, last_user_id, sent, failed, blocked"
+
+
+@_writer
+def create_broadcast(
+    conn: sqlite3.Connection, admin_chat_id: int, from_chat_id: int, message_id: int, lease_until: int
+) -> Broadcast:
+    total = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    cur = conn.execute(
+        """
+        INSERT INTO broadcasts (admin_chat_id, from_chat_id, message_id, total, lease_until)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (admin_chat_id, from_chat_id, message_id, total, lease_until),
+    )
+    return Broadcast(cur.lastrowid, admin_chat_id, from_chat_id, message_id, total, 0, 0, 0, 0)
+
+
+@_writer
+def claim_broadcasts(conn: sqlite3.Connection, lease_until: int) -> List[Broadcast]:
+    # Running broadcasts whose lease lapsed (their process died) move to this process
+    now = int(time.time())
+    rows = conn.execute(
+        f"SELECT {_BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' AND lease_until < ?", (now,)
+    ).fetchall()
+    if rows:
+        conn.executemany("UPDATE broadcasts SET lease_until = ? WHERE id = ?", [(lease_until, row[0]) for row in rows])
+    return [Broadcast._make(row) for row in rows]
+
+
+@_writer
+def renew_broadcasts(conn: sqlite3.Connection, broadcast_ids: List[int], lease_until: int) -> None:
+    conn.executemany(
+        "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND status = 'running'",
+        [(lease_until, broadcast_id) for broadcast_id in broadcast_ids],
+    )
+
+
+@_writer
+def checkpoint_broadcast(conn: sqlite3.Connection, broadcast: Broadcast, lease_until: int) -> bool:
+    # Returns False once the broadcast was stopped, so the sender knows to quit
+    cur = conn.execute(
+        """
+        UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, lease_until = ?
+        WHERE id = ? AND status = 'running'
+        """,
+        (broadcast.last_user_id, broadcast.sent, broadcast.failed, broadcast.blocked, lease_until, broadcast.id),
+    )
+    return cur.rowcount > 0
+
+
+@_writer
+def finish_broadcast(conn: sqlite3.Connection, broadcast_id: int) -> None:
+    conn.execute("UPDATE broadcasts SET status = 'done', lease_until = 0 WHERE id = ? AND status = 'running'", (broadcast_id,))
+
+
+@_writer
+def stop_broadcasts(conn: sqlite3.Connection) -> int:
+    return conn.execute("UPDATE broadcasts SET status = 'stopped' WHERE status = 'running'").rowcount
+
+
+# Imports
+
+class Import(NamedTuple):
+    id: int
+    admin_chat_id: int
+    total: int
+    resolved: int
+    posted: int
+    # The first few problems for the final report, and how many there were in all
+    problems: Tuple[str, ...]
+    problem_count: int
+
+
+_IMPORT_COLUMNS = "id, admin_chat_id, total, resolved, posted, problems, problem_count"
+# (code, file_id, storage_message_id, name, description), as in importer.ImportRow
+_ImportRow = Tuple[str, Optional[str], Optional[int], str, str]
+
+
+def _import_from_row(row: tuple) -> Import:
+    return Import._make((*row[:5], tuple(json.loads(row[5])), row[6]))
+
+
+@_writer
+def _create_import(
+    conn: sqlite3.Connection,
+    admin_chat_id: int,
+    movies: List[Movie],
+    pending: List[_ImportRow],
+    lease_until: int,
+) -> Tuple[List[str], Optional[Import]]:
+    # The movies and the storage-channel work they still need commit together, so a restart
+    # can never leave an inserted row that nobody will post
+    conflicts = _insert_movie_rows(conn, movies)
+    conflicting = set(conflicts)
+    # Unresolved rows (no file_id) weren't inserted yet, so only they can still be pending when conflicting
+    pending = [row for row in pending if row[1] is None or row[0] not in conflicting]
+    if not pending:
+        return conflicts, None
+    cur = conn.execute(
+        "INSERT INTO imports (admin_chat_id, total, lease_until) VALUES (?, ?, ?)",
+        (admin_chat_id, len(pending), lease_until),
+    )
+    conn.executemany(
+        """
+        INSERT INTO import_rows (import_id, code, file_id, storage_message_id, name, description)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [(cur.lastrowid, *row) for row in pending],
+    )
+    return conflicts, Import(cur.lastrowid, admin_chat_id, len(pending), 0, 0, (), 0)
+
+
+async def start_import(
+    admin_chat_id: int, rows: Iterable[_ImportRow], pending: Iterable[_ImportRow], lease_until: int
+) -> Tuple[List[str], Optional[Import]]:
+    movies = [_new_movie(*row) for row in rows]
+    conflicts, job = await _create_import(admin_chat_id, movies, list(pending), lease_until)
+    if len(conflicts) < len(movies):
+        # Rebuild rather than grow the filter past the capacity it was sized for
+        await reload_catalog()
+    return conflicts, job
+
+
+@_writer
+def claim_imports(conn: sqlite3.Connection, lease_until: int) -> List[Import]:
+    # Running imports whose lease lapsed (their process died) move to this process
+    now = int(time.time())
+    rows = conn.execute(
+        f"SELECT {_IMPORT_COLUMNS} FROM imports WHERE status = 'running' AND lease_until < ?", (now,)
+    ).fetchall()
+    if rows:
+        conn.executemany("UPDATE imports SET lease_until = ? WHERE id = ?", [(lease_until, row[0]) for row in rows])
+    return [_import_from_row(row) for row in rows]
+
+
+@_writer
+def renew_imports(conn: sqlite3.Connection, import_ids: List[int], lease_until: int) -> None:
+    conn.executemany(
+        "UPDATE imports SET lease_until = ? WHERE id = ? AND status = 'running'",
+        [(lease_until, import_id) for import_id in import_ids],
+    )
+
+
+@_reader
+def pending_import_rows(conn: sqlite3.Connection, import_id: int, limit: int) -> List[_ImportRow]:
+    return conn.execute(
         """
-        INSERT INTO join_requests (user_id, chat_id, status) VALUES (?, ?, ?)
-        ON CONFLICT(user_id, chat_id) DO UPDATE SET status=excluded.status, requested_at=strftime('%s','now')
+        SELECT code, file_id, storage_message_id, name, description FROM import_rows
+        WHERE import_id = ? ORDER BY code LIMIT ?
         """,
-        (user_id, chat_id, status),
+        (import_id, limit),
+    ).fetchall()
+
+
+def _save_import(conn: sqlite3.Connection, job: Import, lease_until: int) -> None:
+    conn.execute(
+        """
+        UPDATE imports SET resolved = ?, posted = ?, problems = ?, problem_count = ?, lease_until = ?
+        WHERE id = ?
+        """,
+        (
+            job.resolved,
+            job.posted,
+            json.dumps(job.problems, ensure_ascii=False),
+            job.problem_count,
+            lease_until,
+            job.id,
+        ),
     )
-    _conn.commit()
 
 
-def has_pending_join_request(user_id: int, chat_id: int) -> bool:
-    row = _conn.execute(
-        "SELECT 1 FROM join_requests WHERE user_id = ? AND chat_id = ? AND status = 'pending'",
-        (user_id, chat_id),
+@_writer
+def _checkpoint_import(
+    conn: sqlite3.Connection,
+    job: Import,
+    done: List[str],
+    resolved: List[Movie],
+    storage_ids: List[Tuple[int, str]],
+    lease_until: int,
+) -> List[str]:
+    # A batch's results and the removal of its rows commit together; a crash repeats at most one batch
+    conflicts = _insert_movie_rows(conn, resolved)
+    conn.executemany("UPDATE movies SET storage_message_id = ? WHERE code = ?", storage_ids)
+    conn.executemany("DELETE FROM import_rows WHERE import_id = ? AND code = ?", [(job.id, code) for code in done])
+    _save_import(conn, job, lease_until)
+    return conflicts
+
+
+async def checkpoint_import(
+    job: Import,
+    done: List[str],
+    resolved: Iterable[_ImportRow],
+    storage_ids: List[Tuple[int, str]],
+    lease_until: int,
+) -> List[str]:
+    # Returns the resolved codes that turned out to exist already
+    movies = [_new_movie(*row) for row in resolved]
+    conflicts = await _checkpoint_import(job, done, movies, storage_ids, lease_until)
+    conflicting = set(conflicts)
+    for movie in movies:
+        if movie.code not in conflicting:
+            catalog.add(movie)
+    for _, code in storage_ids:
+        catalog.discard(code)
+    return conflicts
+
+
+@_writer
+def finish_import(conn: sqlite3.Connection, job: Import) -> None:
+    _save_import(conn, job, 0)
+    conn.execute("UPDATE imports SET status = 'done' WHERE id = ?", (job.id,))
+
+
+# Movie request stats
+
+_OTHER_CODES = ""
+# Longer texts are titles or chatter rather than codes; they are counted as "other"
+_MAX_STATS_CODE = 64
+
+# Write-behind: (hour, code) -> [hits, misses], added to movie_stats on each flush
+_request_counts: Dict[Tuple[int, str], List[int]] = {}
+
+
+class RequestStats(NamedTuple):
+    hits: int
+    misses: int
+    recent: int
+    top_hits: List[Tuple[str, int]]
+    top_misses: List[Tuple[str, int]]
+
+
+def current_hour() -> int:
+    return int(time.time()) // 3600
+
+
+def count_request(code: str, hit: bool) -> None:
+    key = (current_hour(), code if len(code) <= _MAX_STATS_CODE else _OTHER_CODES)
+    counts = _request_counts.get(key)
+    if counts is None:
+        # Keeps a burst of random codes from growing the buffer without bound
+        if len(_request_counts) >= STATS_MAX_CODES:
+            key = (key[0], _OTHER_CODES)
+            counts = _request_counts.get(key)
+        if counts is None:
+            counts = _request_counts[key] = [0, 0]
+    counts[0 if hit else 1] += 1
+
+
+@_writer
+def _write_movie_stats(conn: sqlite3.Connection, rows: List[Tuple[int, str, int, int]]) -> None:
+    conn.executemany(
+        """
+        INSERT INTO movie_stats (hour, code, hits, misses) VALUES (?, ?, ?, ?)
+        ON CONFLICT(hour, code) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+        """,
+        rows,
+    )
+
+
+async def flush_movie_stats() -> None:
+    if not _request_counts:
+        return
+    batch = dict(_request_counts)
+    _request_counts.clear()
+    try:
+        await _write_movie_stats([(hour, code, hits, misses) for (hour, code), (hits, misses) in batch.items()])
+    except BaseException:
+        # Put the counts back so the next flush writes them
+        for key, (hits, misses) in batch.items():
+            counts = _request_counts.setdefault(key, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+        raise
+
+
+def _top_codes(conn: sqlite3.Connection, column: str, since_hour: int, limit: int) -> List[Tuple[str, int]]:
+    rows = conn.execute(
+        f"""
+        SELECT code, SUM({column}) AS total FROM movie_stats
+        WHERE hour >= ? AND code != ?
+        GROUP BY code HAVING total > 0 ORDER BY total DESC LIMIT ?
+        """,
+        (since_hour, _OTHER_CODES, limit),
+    )
+    return rows.fetchall()
+
+
+@_reader
+def request_stats(conn: sqlite3.Connection, since_hour: int, recent_hour: int, limit: int) -> RequestStats:
+    # Every query is a range over the (hour, code) key, so cost follows the window, not the table
+    hits, misses = conn.execute(
+        "SELECT COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0) FROM movie_stats WHERE hour >= ?", (since_hour,)
+    ).fetchone()
+    (recent,) = conn.execute(
+        "SELECT COALESCE(SUM(hits + misses), 0) FROM movie_stats WHERE hour >= ?", (recent_hour,)
     ).fetchone()
-    return bool(row)
+    return RequestStats(
+        hits,
+        misses,
+        recent,
+        _top_codes(conn, "hits", since_hour, limit),
+        _top_codes(conn, "misses", since_hour, limit),
+    )
+
+
+# Export and backup
+
+_EXPORT_QUERIES = {
+    "movies": "SELECT code, file_id, storage_message_id, name, description FROM movies",
+    "channels": "SELECT invite_link, chat_id FROM channels",
+    "movie_parts": "SELECT code, part, file_id, storage_message_id FROM movie_parts",
+}
+_EXPORT_CHUNK = 500
+
+_backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-backup")
+_backup_cancelled = threading.Event()
+
+
+@_reader
+def export_tables(conn: sqlite3.Connection, directory: str, stamp: str) -> List[Tuple[str, int]]:
+    # One read transaction so every file comes from the same snapshot; rows go to gzip a chunk
+    # at a time instead of being collected in memory. Returns (path, row count) per table.
+    exported = []
+    conn.execute("BEGIN")
+    try:
+        for table, query in _EXPORT_QUERIES.items():
+            path = os.path.join(directory, f"{table}-{stamp}.jsonl.gz")
+            cursor = conn.execute(query)
+            columns = [column[0] for column in cursor.description]
+            count = 0
+            with gzip.open(path, "wt", encoding="utf-8") as out:
+                while True:
+                    rows = cursor.fetchmany(_EXPORT_CHUNK)
+                    if not rows:
+                        break
+                    out.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows)
+                    count += len(rows)
+            exported.append((path, count))
+    finally:
+        conn.rollback()
+    return exported
+
+
+def _backup_progress(status: int, remaining: int, total: int) -> None:
+    if _backup_cancelled.is_set():
+        raise RuntimeError("Backup cancelled")
+    # Between steps no lock is held, so the writer thread gets the connection to itself
+    time.sleep(BACKUP_STEP_PAUSE)
+
+
+def _backup_to(path: str) -> None:
+    # The source is the writer connection: SQLite folds writes made through it into a running
+    # backup, where a write through any other connection would restart the copy from page one
+    target = sqlite3.connect(path)
+    try:
+        _write_connection().backup(target, pages=BACKUP_STEP_PAGES, progress=_backup_progress)
+    finally:
+        target.close()
+
+
+async def backup_database(path: str) -> None:
+    _backup_cancelled.clear()
+    await asyncio.get_running_loop().run_in_executor(_backup_executor, _backup_to, path)
 
 
-def remove_join_request(user_id: int, chat_id: int) -> None:
-    _conn.execute("DELETE FROM join_requests WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
-    _conn.commit()
+def cancel_backup() -> None:
+    _backup_cancelled.set()
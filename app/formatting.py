@@ -0,0 +1,21 @@
+from typing import Optional, Tuple
+
+# Every Markdown special character mapped to its backslash-escaped form, applied in one pass
+_MD_ESCAPES = str.maketrans({ch: "\\" + ch for ch in "_*[]()~`>#+-=|{}.!"})
+
+
+def escape_md(text: str) -> str:
+    return text.translate(_MD_ESCAPES)
+
+
+def format_caption(name: str, description: str, code: Optional[str] = None) -> str:
+    caption = f"*{escape_md(name)}*\n{escape_md(description)}"
+    if code:
+        caption += f"\n`{escape_md(code)}`"
+    return caption
+
+
+def render_captions(code: str, name: Optional[str], description: Optional[str]) -> Tuple[str, str]:
+    # (user caption, storage channel caption); the storage post also shows the code
+    caption = format_caption(name or "", description or "")
+    return caption, f"{caption}\n`{escape_md(code)}`"
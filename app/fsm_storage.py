@@ -0,0 +1,93 @@
+import asyncio
+import functools
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from app.cache import LRUCache
+
+_Record = Tuple[Optional[str], Dict[str, Any]]
+
+
+# Durable FSM storage. Each process owns the keys of the users routed to it, so records are
+# served from an in-memory LRU and written through to SQLite on a dedicated thread.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str, cache_size: int = 10000):
+        self._key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._cache = LRUCache(cache_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-storage")
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}'
+            );
+            """
+        )
+        self._conn.commit()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    def _select(self, key: str) -> _Record:
+        row = self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def _store(self, key: str, state: Optional[str], data: str) -> None:
+        with self._conn:
+            if state is None and data == "{}":
+                self._conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            else:
+                self._conn.execute(
+                    "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data",
+                    (key, state, data),
+                )
+
+    async def _load(self, key: str) -> _Record:
+        record = self._cache.get(key)
+        if record is None:
+            record = await self._run(self._select, key)
+            self._cache.set(key, record)
+        return record
+
+    async def _save(self, key: str, record: _Record) -> None:
+        # Cache first: writes run in FIFO order on one thread, so the table converges to the cache
+        self._cache.set(key, record)
+        await self._run(self._store, key, record[0], json.dumps(record[1]))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key_builder.build(key)
+        _, data = await self._load(storage_key)
+        await self._save(storage_key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        storage_key = self._key_builder.build(key)
+        state, _ = await self._load(storage_key)
+        await self._save(storage_key, (state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key_builder.build(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=False)
@@ -1,8 +1,17 @@
+import asyncio
+import gzip
+import io
 import logging
+import tempfile
+import time
+import weakref
+
 from aiogram import F, Router, types
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
+from aiogram.types import BufferedInputFile, FSInputFile, InputMediaDocument, InputMediaVideo
 
+from app.catalog import catalog
 from app.config import STORAGE_CHANNEL_ID
 from app.db import (
     get_movie_record,
@@ -10,18 +19,42 @@ from app.db import (
     save_movie,
     list_channels,
     get_channel_by_chat_id,
+    movie_lookups,
+    flush_users,
+    stop_broadcasts,
+    current_hour,
+    flush_movie_stats,
+    request_stats,
+    export_tables,
+    part_storage_message_ids,
 )
+from app.formatting import escape_md, render_captions
 from app.keyboards import (
     confirm_channel_delete_keyboard,
     confirm_delete_keyboard,
     delete_button_keyboard,
 )
+from app.profiler import format_collapsed, format_report, profiler
+from app.services import broadcast
 from app.services.channel_links import ChannelLinkService
-from app.states import AddMovie
-from app.utils import escape_md, format_caption, is_admin
+from app.services.importer import format_problems, import_movies, import_parts, read_import
+from app.services.sender import background_priority, send_scheduler
+from app.states import AddMovie, ImportMovies
+from app.utils import is_admin, media_group_chunks, member_checks
 
 router = Router()
 
+_PROFILE_DEFAULT_SECONDS = 30
+_PROFILE_MAX_SECONDS = 300
+_STATS_DEFAULT_HOURS = 24
+_STATS_MAX_HOURS = 24 * 90
+_STATS_TOP = 10
+# deleteMessages accepts at most 100 ids
+_DELETE_BATCH = 100
+_background_tasks = set()
+# chat id -> lock serializing the parts of an /add upload
+_part_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
 
 @router.message(Command("add"))
 async def add_movie(message: types.Message, state: FSMContext):
@@ -34,11 +67,21 @@ async def add_movie(message: types.Message, state: FSMContext):
     await message.answer("Kinoni yuboring.")
 
 
-@router.message(AddMovie.waiting_for_video, F.video)
+@router.message(StateFilter(AddMovie.waiting_for_video, AddMovie.waiting_for_name), F.video)
 async def receive_movie_video(message: types.Message, state: FSMContext):
-    await state.update_data(file_id=message.video.file_id)
-    await state.set_state(AddMovie.waiting_for_name)
-    await message.answer("Kino qabul qilindi. Kino nomini kiriting.")
+    # Each video is a part; the videos of an album arrive as concurrent updates, so appends are
+    # serialized per chat and parts are ordered by message id rather than by arrival
+    lock = _part_locks.get(message.chat.id)
+    if lock is None:
+        lock = _part_locks[message.chat.id] = asyncio.Lock()
+    async with lock:
+        parts = (await state.get_data()).get("parts", []) + [[message.message_id, message.video.file_id]]
+        await state.update_data(parts=parts)
+        await state.set_state(AddMovie.waiting_for_name)
+    if len(parts) == 1:
+        await message.answer("Kino qabul qilindi. Kino nomini kiriting yoki keyingi qismni yuboring.")
+    else:
+        await message.answer(f"{len(parts)}-qism qabul qilindi. Kino nomini kiriting yoki keyingi qismni yuboring.")
 
 
 @router.message(AddMovie.waiting_for_video)
@@ -81,27 +124,42 @@ async def expect_description(message: types.Message):
 @router.message(AddMovie.waiting_for_code, F.text)
 async def receive_movie_code(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    file_id = data.get("file_id")
+    # FSM data saved before multi-part uploads holds a single file_id
+    parts = data.get("parts") or ([[0, data["file_id"]]] if data.get("file_id") else [])
+    file_ids = [file_id for _, file_id in sorted(parts)]
     name = data.get("name", "")
     description = data.get("description", "")
     code = message.text.strip()
-    if not file_id:
+    if not file_ids:
         await message.answer("❌ Xatolik yuz berdi. Qayta urinib ko'ring /add.")
         await state.clear()
         return
     if not code:
         await message.answer("Iltimos, kino kodini text shaklida yuboring.")
         return
-    caption = format_caption(name, description, code)
+    _, caption = render_captions(code, name, description)
     keyboard = delete_button_keyboard(code)
-    sent = await message.bot.send_video(
-        chat_id=STORAGE_CHANNEL_ID,
-        video=file_id,
-        caption=caption,
-        reply_markup=keyboard,
-    )
-    if save_movie(code, file_id, sent.message_id, name, description):
-        await message.answer(f"✅ Kino `{name}` muvaffaqiyatli qo'shildi.")
+    file_id, *extra_file_ids = file_ids
+    with background_priority():
+        sent = await message.bot.send_video(
+            chat_id=STORAGE_CHANNEL_ID,
+            video=file_id,
+            caption=caption,
+            reply_markup=keyboard,
+        )
+        # The first part carries the caption and delete button; the rest follow as albums
+        part_message_ids = []
+        for album in media_group_chunks(extra_file_ids):
+            if len(album) == 1:
+                posted = [await message.bot.send_video(chat_id=STORAGE_CHANNEL_ID, video=album[0])]
+            else:
+                posted = await message.bot.send_media_group(
+                    chat_id=STORAGE_CHANNEL_ID, media=[InputMediaVideo(media=part) for part in album]
+                )
+            part_message_ids.extend(post.message_id for post in posted)
+    if await save_movie(code, file_id, sent.message_id, name, description, extra_file_ids, part_message_ids):
+        parts = f" ({len(file_ids)} qism)" if extra_file_ids else ""
+        await message.answer(f"✅ Kino `{name}`{parts} muvaffaqiyatli qo'shildi.")
     else:
         await message.answer("Bu kod allaqachon ishlatilga. Boshqa kod bilan urinib ko'ring.")
     await state.clear()
@@ -112,6 +170,66 @@ async def expect_code(message: types.Message):
     await message.answer("Iltimos, kino kodini text shaklida yuboring.")
 
 
+async def _run_import(message: types.Message, document: types.Document):
+    await message.answer("Fayl tekshirilmoqda...")
+    filename = document.file_name or ""
+    with tempfile.TemporaryFile() as tmp:
+        await message.bot.download(document, destination=tmp)
+        # /export files are gzipped; they import as they are
+        gzipped = filename.lower().endswith(".gz")
+        raw = gzip.GzipFile(fileobj=tmp) if gzipped else tmp
+        stream = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        loop = asyncio.get_running_loop()
+        try:
+            rows, parts, problems = await loop.run_in_executor(
+                None, read_import, stream, filename[:-3] if gzipped else filename
+            )
+        except (UnicodeDecodeError, ValueError, OSError) as exc:
+            await message.answer(f"❌ Faylni o'qib bo'lmadi: {exc}", parse_mode=None)
+            return
+    inserted, conflicts, pending = await import_movies(message.bot, message.chat.id, rows)
+    problems.extend(f"{code}: code already exists" for code in conflicts)
+    text = f"✅ Imported {inserted} movies."
+    if parts:
+        inserted_parts, part_problems = await import_parts(parts)
+        problems.extend(part_problems)
+        text += f"\n✅ Imported {inserted_parts} parts of multi-part titles."
+    if pending:
+        text += f"\n{pending} rows are being published to the storage channel in the background."
+    if problems:
+        text += f"\n\n{len(problems)} rows skipped:\n" + format_problems(problems)
+    await message.answer(text, parse_mode=None)
+
+
+@router.message(Command("import"))
+async def import_command(message: types.Message, state: FSMContext):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    if STORAGE_CHANNEL_ID is None:
+        await message.answer("Storage channel is not configured.")
+        return
+    if message.document:
+        await _run_import(message, message.document)
+        return
+    await state.set_state(ImportMovies.waiting_for_file)
+    await message.answer(
+        "CSV yoki JSONL faylni yuboring. Ustunlar: code, file_id yoki storage_message_id, name, description "
+        "(qismlar uchun: code, part, file_id).",
+        parse_mode=None,
+    )
+
+
+@router.message(ImportMovies.waiting_for_file, F.document)
+async def receive_import_file(message: types.Message, state: FSMContext):
+    await state.clear()
+    await _run_import(message, message.document)
+
+
+@router.message(ImportMovies.waiting_for_file)
+async def expect_import_file(message: types.Message):
+    await message.answer("Iltimos, faylni hujjat shaklida yuboring.")
+
+
 @router.message(Command("remove"))
 async def remove_movie_command(message: types.Message):
     if message.from_user is None or not is_admin(message.from_user.id):
@@ -121,7 +239,7 @@ async def remove_movie_command(message: types.Message):
         await message.answer("Ishlatish: /remove <code>")
         return
     code = parts[1].strip()
-    record = get_movie_record(code)
+    record = await get_movie_record(code)
     if not record:
         await message.answer("Kino topilmadi.")
         return
@@ -165,7 +283,7 @@ async def delete_confirm(callback: types.CallbackQuery):
     if callback.from_user is None or not is_admin(callback.from_user.id):
         await callback.answer("Not authorized", show_alert=True)
         return
-    record = get_movie_record(code)
+    record = await get_movie_record(code)
     if not record:
         await callback.answer("Kino topilmadi", show_alert=True)
         try:
@@ -174,13 +292,19 @@ async def delete_confirm(callback: types.CallbackQuery):
         except Exception:  # noqa
             pass
         return
-    _, _, storage_message_id, _, _ = record
-    removed = remove_movie(code)
-    if STORAGE_CHANNEL_ID and storage_message_id:
-        try:
-            await callback.bot.delete_message(chat_id=STORAGE_CHANNEL_ID, message_id=storage_message_id)
-        except Exception:  # noqa
-            pass
+    # The first part's post plus the album posts of the rest
+    storage_message_ids = [record.storage_message_id] if record.storage_message_id else []
+    if record.extra_file_ids:
+        storage_message_ids.extend(await part_storage_message_ids(code))
+    removed = await remove_movie(code)
+    if STORAGE_CHANNEL_ID and storage_message_ids:
+        for start in range(0, len(storage_message_ids), _DELETE_BATCH):
+            try:
+                await callback.bot.delete_messages(
+                    chat_id=STORAGE_CHANNEL_ID, message_ids=storage_message_ids[start:start + _DELETE_BATCH]
+                )
+            except Exception:  # noqa
+                pass
     await callback.answer("✅ Kino o'chirildi" if removed else "❌ Xatolik yuz berdi", show_alert=True)
     if callback.message:
         try:
@@ -223,7 +347,7 @@ async def add_channel_command(message: types.Message):
 async def list_channels_command(message: types.Message):
     if message.from_user is None or not is_admin(message.from_user.id):
         return
-    channels = list_channels()
+    channels = await list_channels()
     if not channels:
         await message.answer("No channels configured.")
         return
@@ -244,7 +368,7 @@ async def remove_channel_command(message: types.Message):
     except ValueError:
         await message.answer("chat_id must be an integer")
         return
-    channel = get_channel_by_chat_id(chat_id)
+    channel = await get_channel_by_chat_id(chat_id)
     if not channel:
         await message.answer("Channel not found.")
         return
@@ -279,7 +403,7 @@ async def channel_delete_confirm(callback: types.CallbackQuery):
     except ValueError:
         await callback.answer("Invalid channel id.", show_alert=True)
         return
-    channel = get_channel_by_chat_id(chat_id)
+    channel = await get_channel_by_chat_id(chat_id)
     if not channel:
         await callback.answer("Channel not found.", show_alert=True)
         return
@@ -302,6 +426,161 @@ async def channel_delete_confirm(callback: types.CallbackQuery):
             pass
 
 
+@router.message(Command("cachestats"))
+async def cache_stats_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    stats = catalog.stats()
+    await message.answer(
+        "Movie cache:\n"
+        f"- cached: {stats['cached']}\n"
+        f"- hits: {stats['hits']}\n"
+        f"- misses: {stats['misses']}\n"
+        f"- rejected by filter: {stats['filtered']}\n"
+        f"- false positives: {stats['false_positives']}\n"
+        f"- lookups sharing an in-flight query: {movie_lookups.shared}\n"
+        f"- membership checks sharing an in-flight call: {member_checks.shared}",
+        parse_mode=None,
+    )
+
+
+@router.message(Command("sendstats"))
+async def send_stats_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    stats = send_scheduler.stats()
+    await message.answer(
+        "Outbound queue:\n"
+        f"- queued: {stats['queued']}\n"
+        f"- waiting on chat limit: {stats['chat_waiting']}\n"
+        f"- sent: {stats['sent']}\n"
+        f"- retries after 429: {stats['retries']}\n"
+        f"- avg wait: {stats['avg_wait']:.3f}s\n"
+        f"- max wait: {stats['max_wait']:.3f}s",
+        parse_mode=None,
+    )
+
+
+@router.message(Command("stats"))
+async def stats_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    parts = message.text.split(maxsplit=1)
+    try:
+        hours = int(parts[1]) if len(parts) > 1 else _STATS_DEFAULT_HOURS
+    except ValueError:
+        await message.answer("Ishlatish: /stats [hours]")
+        return
+    if not 1 <= hours <= _STATS_MAX_HOURS:
+        await message.answer(f"Hours must be between 1 and {_STATS_MAX_HOURS}.", parse_mode=None)
+        return
+    await flush_movie_stats()
+    hour = current_hour()
+    # The previous full hour plus the current partial one
+    stats = await request_stats(hour - hours + 1, hour - 1, _STATS_TOP)
+    recent_minutes = 60 + (time.time() % 3600) / 60
+    total = stats.hits + stats.misses
+    lines = [
+        f"Requests, last {hours}h:",
+        f"- total: {total}",
+        f"- miss rate: {stats.misses / total:.1%}" if total else "- miss rate: n/a",
+        f"- per minute (last hour): {stats.recent / recent_minutes:.1f}",
+        "",
+        f"Top {_STATS_TOP} codes:",
+    ]
+    lines.extend(f"{count:>6}  {code}" for code, count in stats.top_hits)
+    lines.extend(["", f"Top {_STATS_TOP} missing codes:"])
+    lines.extend(f"{count:>6}  {code}" for code, count in stats.top_misses)
+    await message.answer("\n".join(lines), parse_mode=None)
+
+
+async def _run_profile(message: types.Message, seconds: float):
+    try:
+        report = await profiler.run(seconds)
+    except Exception as e:  # noqa
+        logging.error(e)
+        await message.answer(f"❌ Profiling failed: {e}", parse_mode=None)
+        return
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    await message.answer_media_group(
+        [
+            InputMediaDocument(
+                media=BufferedInputFile(format_report(report).encode(), filename=f"profile-{stamp}.txt"),
+            ),
+            InputMediaDocument(
+                media=BufferedInputFile(format_collapsed(report).encode(), filename=f"profile-{stamp}.folded"),
+                caption=f"Profile: {report.duration:.0f}s, {report.samples} samples. "
+                "The .folded file is collapsed stacks for flamegraph.pl or speedscope.",
+                parse_mode=None,
+            ),
+        ]
+    )
+
+
+@router.message(Command("profile"))
+async def profile_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    parts = message.text.split(maxsplit=1)
+    try:
+        seconds = float(parts[1]) if len(parts) > 1 else _PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await message.answer("Ishlatish: /profile [seconds]")
+        return
+    if not 1 <= seconds <= _PROFILE_MAX_SECONDS:
+        await message.answer(f"Duration must be between 1 and {_PROFILE_MAX_SECONDS} seconds.", parse_mode=None)
+        return
+    if profiler.running:
+        await message.answer("A profile is already running.", parse_mode=None)
+        return
+    # Runs in the background so the handler (and a webhook response) doesn't wait for it
+    task = asyncio.create_task(_run_profile(message, seconds))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    await message.answer(f"Profiling the event loop for {seconds:g}s...", parse_mode=None)
+
+
+@router.message(Command("export"))
+async def export_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    with tempfile.TemporaryDirectory(prefix="kino-export-") as directory:
+        try:
+            exported = await export_tables(directory, stamp)
+        except Exception as e:  # noqa
+            logging.error(e)
+            await message.answer(f"❌ Export failed: {e}", parse_mode=None)
+            return
+        await message.answer_media_group(
+            [
+                InputMediaDocument(media=FSInputFile(path), caption=f"{count} rows", parse_mode=None)
+                for path, count in exported
+            ]
+        )
+
+
+@router.message(Command("broadcast"))
+async def broadcast_command(message: types.Message):
+    if message.from_user is None or not is_admin(message.from_user.id):
+        return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) > 1 and parts[1].strip() == "stop":
+        stopped = await stop_broadcasts()
+        await message.answer(f"Stopped {stopped} broadcast(s).", parse_mode=None)
+        return
+    source = message.reply_to_message
+    if source is None:
+        await message.answer(
+            "Reply with /broadcast to the message you want to send to every user. /broadcast stop cancels.",
+            parse_mode=None,
+        )
+        return
+    await flush_users()
+    started = await broadcast.start_broadcast(message.bot, message.chat.id, source.chat.id, source.message_id)
+    await message.answer(f"Broadcast #{started.id} started for {started.total} users.", parse_mode=None)
+
+
 @router.message(Command("cancel"), StateFilter("*"))
 async def cancel_process(message: types.Message, state: FSMContext):
     if message.from_user is None or not is_admin(message.from_user.id):
@@ -316,11 +595,20 @@ async def admin_help(message: types.Message):
         return
     help_text = (
         "Admin commands:\n"
-        "- /add — start adding a new movie (video → name → description → code).\n"
+        "- /add — start adding a new movie (video → name → description → code); "
+        "send several videos for a multi-part title.\n"
         "- /remove <code> — delete a movie by its code (asks for confirmation).\n"
+        "- /import — bulk import movies from a CSV/JSONL file (code, file\\_id or storage\\_message\\_id, name, description).\n"
+        "  Rows with a part column (code, part, file\\_id) add parts to existing titles; /export files import as they are.\n"
         "- /addchannel <chat\\_id> <invite\\_link> — register a required channel (bot must be admin).\n"
         "- /channels — list configured required channels.\n"
         "- /removechannel <chat\\_id> — remove a required channel (asks for confirmation).\n"
+        "- /cachestats — show movie cache hit/miss counters.\n"
+        "- /sendstats — show outbound queue depth and wait times.\n"
+        "- /stats [hours] — top requested and missing codes, miss rate and requests per minute.\n"
+        "- /profile [seconds] — profile the running bot and send back the report.\n"
+        "- /export — download the movies and channels tables as gzipped JSONL.\n"
+        "- /broadcast — reply to a message to send it to every user; /broadcast stop cancels.\n"
         "- /cancel — cancel any ongoing process and clear state."
     )
     await message.answer(help_text)
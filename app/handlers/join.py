@@ -3,6 +3,7 @@ from aiogram.enums import ChatMemberStatus
 from aiogram.types import ChatJoinRequest, ChatMemberUpdated
 
 from app import db
+from app.utils import membership_cache
 
 router = Router()
 
@@ -10,7 +11,8 @@ router = Router()
 @router.chat_join_request()
 async def handle_join_request(event: ChatJoinRequest):
     # Store pending join request so users can be treated as eligible while awaiting approval
-    db.upsert_join_request(user_id=event.from_user.id, chat_id=event.chat.id, status="pending")
+    await db.upsert_join_request(user_id=event.from_user.id, chat_id=event.chat.id, status="pending")
+    membership_cache.set((event.from_user.id, event.chat.id), True)
 
 
 @router.chat_member()
@@ -20,7 +22,12 @@ async def handle_chat_member(update: ChatMemberUpdated):
     chat_id = update.chat.id
     if new_status in {ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR}:
         # Remove pending request once user is admitted
-        db.remove_join_request(user_id=user_id, chat_id=chat_id)
+        await db.remove_join_request(user_id=user_id, chat_id=chat_id)
+        membership_cache.set((user_id, chat_id), True)
     elif new_status in {ChatMemberStatus.LEFT, ChatMemberStatus.KICKED}:
         # Cleanup any lingering requests if user leaves/removed
-        db.remove_join_request(user_id=user_id, chat_id=chat_id)
+        await db.remove_join_request(user_id=user_id, chat_id=chat_id)
+        membership_cache.set((user_id, chat_id), False)
+    else:
+        # Restricted and other transitions are re-checked against the API on next use
+        membership_cache.pop((user_id, chat_id))
@@ -1,22 +1,78 @@
+import hashlib
+
 from aiogram import F, Router, types
 from aiogram.filters import Command
 
-from app.db import get_movie_record
-from app.keyboards import build_join_keyboard
-from app.utils import format_caption, is_member
+from app.cache import TTLCache
+from app.catalog import Movie, catalog
+from app.config import (
+    CALLBACK_DEBOUNCE,
+    CODE_SUGGESTIONS,
+    INLINE_CACHE_TIME,
+    INLINE_RESULTS_LIMIT,
+    SEARCH_PAGE_SIZE,
+)
+from app.db import count_request, get_movie_record, get_movie_records, search_movies, touch_user
+from app.keyboards import build_join_keyboard, code_suggestions_keyboard, search_results_keyboard
+from app.utils import is_member, media_group_chunks
 
 router = Router()
 
+# Terminal replies are returned rather than awaited. In webhook mode, answers and edits go back in
+# the webhook response itself, while messages are sent through the send scheduler; in polling mode
+# the dispatcher executes them as usual.
+
+
+@router.message.outer_middleware()
+@router.callback_query.outer_middleware()
+async def track_user(handler, event, data):
+    # Only an in-memory write; db.flush_users persists last-seen times in batches
+    user = data.get("event_from_user")
+    chat = data.get("event_chat")
+    if user is not None and chat is not None and chat.type == "private":
+        touch_user(user.id)
+    return await handler(event, data)
+
+
+# (user_id, callback data) of recent presses; repeats inside the window are dropped
+_recent_presses = TTLCache(ttl=CALLBACK_DEBOUNCE, maxsize=10000)
+
+
+def _repeated_press(callback: types.CallbackQuery) -> bool:
+    key = (callback.from_user.id, callback.data)
+    if _recent_presses.get(key):
+        return True
+    _recent_presses.set(key, True)
+    return False
+
+
+async def _deliver(message: types.Message, movie: Movie):
+    # The caption was rendered when the movie was saved
+    if not movie.extra_file_ids:
+        return message.answer_video(video=movie.file_id, caption=movie.caption)
+    # A multi-part title goes out as albums of up to ten videos, the caption on the first part
+    media = [types.InputMediaVideo(media=file_id) for file_id in movie.extra_file_ids]
+    media.insert(0, types.InputMediaVideo(media=movie.file_id, caption=movie.caption))
+    albums = media_group_chunks(media)
+    for album in albums[:-1]:
+        await message.answer_media_group(list(album))
+    return message.answer_media_group(list(albums[-1]))
+
+
+async def _search_page(query: str, offset: int):
+    results = await search_movies(query, limit=SEARCH_PAGE_SIZE + 1, offset=offset)
+    has_more = len(results) > SEARCH_PAGE_SIZE
+    return results[:SEARCH_PAGE_SIZE], has_more
+
 
 @router.message(Command("start"))
 async def start_command(message: types.Message):
     if message.from_user is None:
         return
     if not await is_member(message.bot, message.from_user.id):
-        keyboard = build_join_keyboard()
-        await message.answer("You must join the required channels to use this bot.", reply_markup=keyboard)
-        return
-    await message.answer("Welcome! Send the movie code to receive the file.")
+        keyboard = await build_join_keyboard()
+        return message.answer("You must join the required channels to use this bot.", reply_markup=keyboard)
+    return message.answer("Welcome! Send the movie code to receive the file.")
 
 
 @router.message(F.text)
@@ -24,34 +80,125 @@ async def handle_movie_request(message: types.Message):
     if message.from_user is None:
         return
     if not await is_member(message.bot, message.from_user.id):
-        keyboard = build_join_keyboard()
-        await message.answer("You must join the required channels to use this bot.", reply_markup=keyboard)
-        return
+        keyboard = await build_join_keyboard()
+        return message.answer("You must join the required channels to use this bot.", reply_markup=keyboard)
     code = message.text.strip()
-    record = get_movie_record(code)
-    if not record:
-        await message.answer("Invalid or unknown movie code.")
-        return
-    _, file_id, _, name, description = record
-    caption = format_caption(name or "", description or "")
-    await message.bot.send_video(chat_id=message.chat.id, video=file_id, caption=caption)
+    record = await get_movie_record(code)
+    if record is None:
+        # The same code typed in another case or with stray spaces
+        canonical = catalog.match_code(code)
+        if canonical is not None and canonical != code:
+            record = await get_movie_record(canonical)
+    if record:
+        count_request(record.code, True)
+        return await _deliver(message, record)
+    # Anything with letters may be a title; pure digit guesses never reach the search index
+    if any(ch.isalpha() for ch in code):
+        results, has_more = await _search_page(code, 0)
+        if results:
+            return message.reply(
+                "Movies matching your search:",
+                reply_markup=search_results_keyboard(results, 0, has_more),
+            )
+    # Only now is it a missed code; a title search that found something isn't one
+    count_request(code, False)
+    suggestions = catalog.suggest_codes(code, CODE_SUGGESTIONS)
+    if suggestions:
+        return message.answer("Unknown movie code. Did you mean:", reply_markup=code_suggestions_keyboard(suggestions))
+    return message.answer("Invalid or unknown movie code.")
 
 
 @router.message()
 async def unsupported_message(message: types.Message):
-    await message.answer("Send a movie code as text.")
+    return message.answer("Send a movie code as text.")
+
+
+@router.callback_query(F.data.startswith("movie:"))
+async def send_search_result(callback: types.CallbackQuery):
+    if callback.from_user is None or callback.message is None or _repeated_press(callback):
+        await callback.answer()
+        return
+    if not await is_member(callback.bot, callback.from_user.id):
+        await callback.answer("You must join the required channels to use this bot.", show_alert=True)
+        return
+    code = callback.data.split(":", 1)[1]
+    record = await get_movie_record(code)
+    count_request(code, record is not None)
+    if not record:
+        await callback.answer("Movie not found.", show_alert=True)
+        return
+    await callback.answer()
+    return await _deliver(callback.message, record)
+
+
+@router.callback_query(F.data.startswith("search:"))
+async def paginate_search(callback: types.CallbackQuery):
+    # The results message replies to the user's query, so pagination needs no server-side state
+    message = callback.message
+    if not isinstance(message, types.Message) or message.reply_to_message is None or not message.reply_to_message.text:
+        await callback.answer()
+        return
+    if _repeated_press(callback):
+        await callback.answer()
+        return
+    try:
+        offset = max(int(callback.data.split(":", 1)[1]), 0)
+    except ValueError:
+        await callback.answer()
+        return
+    results, has_more = await _search_page(message.reply_to_message.text.strip(), offset)
+    await callback.answer()
+    if results:
+        return message.edit_reply_markup(reply_markup=search_results_keyboard(results, offset, has_more))
+
+
+@router.inline_query()
+async def inline_search(query: types.InlineQuery):
+    # Results depend on the caller's membership, so Telegram must cache them per user
+    if not await is_member(query.bot, query.from_user.id):
+        return query.answer(
+            [],
+            cache_time=0,
+            is_personal=True,
+            button=types.InlineQueryResultsButton(text="Join the required channels", start_parameter="join"),
+        )
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    codes = catalog.prefix_search(query.query, limit=INLINE_RESULTS_LIMIT + 1, offset=offset)
+    has_more = len(codes) > INLINE_RESULTS_LIMIT
+    codes = codes[:INLINE_RESULTS_LIMIT]
+    records = await get_movie_records(codes)
+    results = []
+    for code in codes:
+        record = records.get(code)
+        if record is None:
+            continue
+        results.append(
+            types.InlineQueryResultCachedVideo(
+                id=hashlib.md5(code.encode()).hexdigest(),
+                video_file_id=record.file_id,
+                title=record.name or code,
+                description=code,
+                caption=record.caption,
+            )
+        )
+    return query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=str(offset + INLINE_RESULTS_LIMIT) if has_more else "",
+    )
 
 
 @router.callback_query(F.data == "recheck_membership")
 async def recheck_membership(callback: types.CallbackQuery):
-    if callback.from_user is None:
+    if callback.from_user is None or _repeated_press(callback):
         await callback.answer()
         return
     await callback.answer()
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id if callback.message else callback.from_user.id
     if not await is_member(callback.bot, user_id):
-        keyboard = build_join_keyboard()
+        keyboard = await build_join_keyboard()
         await callback.bot.send_message(
             chat_id,
             "You must join the required channels to use this bot.",
@@ -59,4 +206,3 @@ async def recheck_membership(callback: types.CallbackQuery):
         )
     else:
         await callback.bot.send_message(chat_id, "Welcome! Send the movie code to receive the file.")
-
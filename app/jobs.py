@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+from aiogram import Bot
+
+from app import db
+from app.config import (
+    BACKUP_INTERVAL,
+    BROADCAST_LEASE,
+    IMPORT_LEASE,
+    JOIN_REQUEST_MAX_AGE,
+    JOIN_RETENTION_INTERVAL,
+    STATS_FLUSH_INTERVAL,
+    USER_FLUSH_INTERVAL,
+)
+from app.services import backup, broadcast, importer
+
+_tasks: List[asyncio.Task] = []
+
+
+async def _every(interval: float, job: Callable[[], Awaitable[None]]):
+    while True:
+        try:
+            await job()
+        except Exception as e:  # noqa
+            logging.error(e)
+        await asyncio.sleep(interval)
+
+
+async def _expire_join_requests():
+    expired = await db.expire_join_requests(JOIN_REQUEST_MAX_AGE)
+    if expired:
+        logging.info("Expired %s stale join requests", expired)
+
+
+async def start_jobs(bot: Bot):
+    _tasks.append(asyncio.create_task(_every(JOIN_RETENTION_INTERVAL, _expire_join_requests)))
+    _tasks.append(asyncio.create_task(_every(USER_FLUSH_INTERVAL, db.flush_users)))
+    _tasks.append(asyncio.create_task(_every(STATS_FLUSH_INTERVAL, db.flush_movie_stats)))
+    if BACKUP_INTERVAL:
+        _tasks.append(asyncio.create_task(_every(BACKUP_INTERVAL, backup.scheduled_backup)))
+    # Several times per lease, so our own leases are renewed well before they lapse
+    _tasks.append(asyncio.create_task(_every(BROADCAST_LEASE / 3, lambda: broadcast.resume_broadcasts(bot))))
+    _tasks.append(asyncio.create_task(_every(IMPORT_LEASE / 3, lambda: importer.resume_imports(bot))))
+
+
+async def stop_jobs():
+    # A backup runs on its own thread; cancelling its task alone would leave the copy going
+    db.cancel_backup()
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    await broadcast.stop_running()
+    await importer.stop_running()
+    # Don't lose buffered join-request changes, last-seen times or request counts on shutdown
+    await db.flush_join_requests()
+    await db.flush_users()
+    await db.flush_movie_stats()
@@ -1,6 +1,12 @@
+from typing import List, Optional, Tuple
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 from app import db
+from app.config import SEARCH_PAGE_SIZE
+
+# (channels version, rendered markup); rebuilt only after the channel list changes
+_join_keyboard: Optional[Tuple[int, InlineKeyboardMarkup]] = None
 
 
 def delete_button_keyboard(code: str) -> InlineKeyboardMarkup:
@@ -31,11 +37,46 @@ def confirm_channel_delete_keyboard(chat_id: int) -> InlineKeyboardMarkup:
     )
 
 
-def build_join_keyboard() -> InlineKeyboardMarkup:
+def search_results_keyboard(results: List[Tuple[str, str]], offset: int, has_more: bool) -> InlineKeyboardMarkup:
+    rows = []
+    for code, name in results:
+        callback_data = f"movie:{code}"
+        # Telegram caps callback data at 64 bytes
+        if len(callback_data.encode()) > 64:
+            continue
+        rows.append([InlineKeyboardButton(text=f"{name or code} ({code})", callback_data=callback_data)])
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"search:{max(offset - SEARCH_PAGE_SIZE, 0)}"))
+    if has_more:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"search:{offset + SEARCH_PAGE_SIZE}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def code_suggestions_keyboard(codes: List[str]) -> InlineKeyboardMarkup:
+    # Same callback as search results, so a press goes through the usual delivery path
+    rows = [
+        [InlineKeyboardButton(text=code, callback_data=f"movie:{code}")]
+        for code in codes
+        if len(f"movie:{code}".encode()) <= 64
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def build_join_keyboard() -> InlineKeyboardMarkup:
+    global _join_keyboard
+    version = db.channels_version()
+    if _join_keyboard is not None and _join_keyboard[0] == version:
+        return _join_keyboard[1]
     rows = []
-    channels = db.list_channels()
+    channels = await db.list_channels()
     for idx, channel in enumerate(channels, start=1):
         label = f"Channel {idx}"
         rows.append([InlineKeyboardButton(text=label, url=channel.invite_link)])
     rows.append([InlineKeyboardButton(text="✅ Confirm", callback_data="recheck_membership")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
\ No newline at end of file
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
+    if version == db.channels_version():
+        _join_keyboard = (version, keyboard)
+    return keyboard
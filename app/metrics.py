@@ -0,0 +1,202 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+# Latency buckets in seconds, from cache hits to slow Bot API calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Observations come from the event loop and the DB threads, so updates take a lock; it is
+# uncontended almost always and far cheaper than anything being measured.
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: a count per bucket (not cumulative; the last slot is +Inf), then the sum
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            slots = self._values.get(labels)
+            if slots is None:
+                slots = self._values[labels] = [0] * (len(self.buckets) + 2)
+            slots[index] += 1
+            slots[-1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = [(labels, list(slots)) for labels, slots in self._values.items()]
+        for labels, slots in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), slots):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket = _labels(self.labelnames, labels, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {slots[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+update_duration = Histogram(
+    "kino_update_duration_seconds", "Time spent processing an update", ("update_type", "handler", "outcome")
+)
+db_duration = Histogram("kino_db_duration_seconds", "Time spent running a database function", ("function",))
+db_queue_wait = Histogram(
+    "kino_db_queue_wait_seconds", "Time a database call waited for a free connection thread", ("pool",)
+)
+update_queue_wait = Histogram(
+    "kino_update_queue_wait_seconds", "Time a polled update waited for a processing slot", ("update_type",)
+)
+api_duration = Histogram("kino_api_request_duration_seconds", "Bot API request latency", ("method",))
+api_errors = Counter("kino_api_errors_total", "Bot API requests that failed", ("method", "error"))
+api_rate_limited = Counter("kino_api_rate_limited_total", "Bot API requests answered with 429", ("method",))
+
+# Filled by HandlerMetrics so UpdateMetrics, which runs before routing, can label by handler
+_current_handler: ContextVar[Optional[List[str]]] = ContextVar("current_handler", default=None)
+
+
+# Outer update middleware: one observation per update, labelled with the handler that took it
+class UpdateMetrics(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        holder = ["none"]
+        token = _current_handler.set(holder)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(event, data)
+            outcome = "unhandled" if result is UNHANDLED else "ok"
+            return result
+        finally:
+            update_duration.observe(time.perf_counter() - started, event.event_type, holder[0], outcome)
+            _current_handler.reset(token)
+
+
+# Inner middleware on the event observers; it only runs once a handler has matched
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        holder = _current_handler.get()
+        callback = data.get("handler")
+        if holder is not None and callback is not None:
+            func = callback.callback
+            holder[0] = f"{func.__module__.rpartition('.')[2]}.{func.__name__}"
+        return await handler(event, data)
+
+
+# Session middleware timing each Bot API request; installed inside the send scheduler so
+# throttling waits are not counted and every 429 retry is seen on its own
+class ApiMetrics(BaseRequestMiddleware):
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            api_rate_limited.inc(name)
+            raise
+        except Exception as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            api_duration.observe(time.perf_counter() - started, name)
+
+
+def setup(dp: Dispatcher) -> None:
+    dp.update.outer_middleware(UpdateMetrics())
+    middleware = HandlerMetrics()
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(middleware)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+from aiogram.utils.backoff import Backoff, BackoffConfig
+
+from app import metrics
+from app.config import UPDATE_CONCURRENCY, UPDATE_DRAIN_TIMEOUT, UPDATE_QUEUE_SIZE, UPDATE_TYPE_LIMITS
+from app.utils import is_admin
+
+_ADMIN, _INTERACTIVE, _BACKGROUND = range(3)
+_INTERACTIVE_TYPES = {"message", "edited_message", "callback_query", "inline_query"}
+
+_BACKOFF = BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1)
+
+# (priority, update type); one FIFO per key so a capped type never blocks the others
+_Key = Tuple[int, str]
+
+
+def _classify(update: Update) -> _Key:
+    try:
+        update_type = update.event_type
+    except UpdateTypeLookupError:
+        return _BACKGROUND, "unknown"
+    user = getattr(update.event, "from_user", None)
+    if user is not None and is_admin(user.id):
+        return _ADMIN, update_type
+    return (_INTERACTIVE if update_type in _INTERACTIVE_TYPES else _BACKGROUND), update_type
+
+
+# Replaces aiogram's task-per-update polling: updates wait in a bounded queue and run with at
+# most `concurrency` in flight (fewer for capped types), admins first, then user messages and
+# buttons, then membership noise. A full queue blocks put(), which stops the fetch loop.
+# With `ordered`, a user's updates of one type also finish in the order they arrived.
+class UpdateScheduler:
+    def __init__(self, concurrency: int, queue_size: int, type_limits: Dict[str, int], ordered: bool = False):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.type_limits = type_limits
+        self.ordered = ordered
+        # (user id, key) -> that user's latest started update of that key
+        self._tails: Dict[Tuple[int, _Key], asyncio.Task] = {}
+        # key -> (sequence, queued at, update)
+        self._queues: Dict[_Key, Deque[Tuple[int, float, Update]]] = {}
+        self._size = 0
+        self._sequence = 0
+        self._active = 0
+        self._active_by_type: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._changed = asyncio.Condition()
+        self._closed = False
+        # Update ids queued or running; updates finish out of order, so only the oldest of
+        # these bounds what may be confirmed to Telegram
+        self._unfinished: Set[int] = set()
+        self._last_id: Optional[int] = None
+
+    @property
+    def pending(self) -> int:
+        return self._size + self._active
+
+    @property
+    def unfinished(self) -> int:
+        return len(self._unfinished)
+
+    @property
+    def processed_offset(self) -> Optional[int]:
+        # Offset that confirms every update finished so far and nothing after the oldest unfinished one
+        if self._unfinished:
+            return min(self._unfinished)
+        return None if self._last_id is None else self._last_id + 1
+
+    async def put(self, update: Update) -> None:
+        key = _classify(update)
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._size < self.queue_size)
+            self._sequence += 1
+            self._queues.setdefault(key, deque()).append((self._sequence, time.monotonic(), update))
+            self._size += 1
+            self._unfinished.add(update.update_id)
+            self._last_id = update.update_id
+            self._changed.notify_all()
+
+    async def close(self) -> None:
+        # run() returns once everything queued so far has been processed
+        async with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def _next(self) -> Optional[_Key]:
+        if self._active >= self.concurrency:
+            return None
+        best: Optional[Tuple[int, int, _Key]] = None
+        for key, queue in self._queues.items():
+            if not queue:
+                continue
+            limit = self.type_limits.get(key[1])
+            if limit is not None and self._active_by_type.get(key[1], 0) >= limit:
+                continue
+            candidate = (key[0], queue[0][0], key)
+            if best is None or candidate < best:
+                best = candidate
+        return best[2] if best else None
+
+    async def run(self, dp: Dispatcher, bot: Bot, **kwargs: Any) -> None:
+        try:
+            async with self._changed:
+                while True:
+                    await self._changed.wait_for(lambda: self._next() is not None or (self._closed and not self._size))
+                    key = self._next()
+                    if key is None:
+                        break
+                    _, queued_at, update = self._queues[key].popleft()
+                    self._size -= 1
+                    self._active += 1
+                    self._active_by_type[key[1]] = self._active_by_type.get(key[1], 0) + 1
+                    metrics.update_queue_wait.observe(time.monotonic() - queued_at, key[1])
+                    ordered = self.ordered and key[1] != "unknown"
+                    user = getattr(update.event, "from_user", None) if ordered else None
+                    tail = (user.id, key) if user is not None else None
+                    # Each key is FIFO, so the previous update waited on is already running
+                    previous = self._tails.get(tail) if tail else None
+                    task = asyncio.create_task(self._process(dp, bot, update, key[1], kwargs, previous))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    if tail:
+                        self._tails[tail] = task
+                        task.add_done_callback(
+                            lambda t, k=tail: self._tails.pop(k) if self._tails.get(k) is t else None
+                        )
+                    # A slot in the queue just freed up
+                    self._changed.notify_all()
+            if self._tasks:
+                await asyncio.wait(list(self._tasks))
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    async def _process(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        update: Update,
+        update_type: str,
+        kwargs: Dict[str, Any],
+        previous: Optional[asyncio.Task] = None,
+    ):
+        finished = False
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            result = await dp.feed_update(bot, update, **kwargs)
+            if isinstance(result, TelegramMethod):
+                await dp.silent_call_request(bot=bot, result=result)
+            finished = True
+        except Exception:  # noqa
+            logging.exception("Failed to process update %s", update.update_id)
+            finished = True
+        finally:
+            # A task cancelled by a drain timeout stays unfinished so it is never confirmed
+            if finished:
+                self._unfinished.discard(update.update_id)
+            async with self._changed:
+                self._active -= 1
+                self._active_by_type[update_type] -= 1
+                self._changed.notify_all()
+
+
+async def run_polling(
+    dp: Dispatcher,
+    bot: Bot,
+    polling_timeout: int = 30,
+    handle_signals: bool = True,
+    stop: Optional[asyncio.Event] = None,
+):
+    stop = stop or asyncio.Event()
+    if handle_signals:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+    scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_QUEUE_SIZE, UPDATE_TYPE_LIMITS)
+    allowed_updates = dp.resolve_used_update_types()
+
+    async def fetch():
+        offset: Optional[int] = None
+        backoff = Backoff(_BACKOFF)
+        request_timeout = int(bot.session.timeout + polling_timeout)
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=polling_timeout,
+                    allowed_updates=allowed_updates,
+                    request_timeout=request_timeout,
+                )
+            except Exception as e:  # noqa
+                logging.error("Failed to fetch updates: %s", e)
+                await backoff.asleep()
+                continue
+            backoff.reset()
+            for update in updates:
+                # Waits while the queue is full; nothing more is fetched until it drains
+                await scheduler.put(update)
+                offset = update.update_id + 1
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    dispatching = asyncio.create_task(scheduler.run(dp, bot, bots=[bot]))
+    fetching = asyncio.create_task(fetch())
+    logging.info("Polling with up to %s concurrent updates", UPDATE_CONCURRENCY)
+    try:
+        await stop.wait()
+    finally:
+        fetching.cancel()
+        with suppress(asyncio.CancelledError):
+            await fetching
+        logging.info("Polling stopped; draining %s updates", scheduler.pending)
+        await scheduler.close()
+        try:
+            await asyncio.wait_for(dispatching, UPDATE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(
+                "Gave up waiting for updates after %ss; %s will be delivered again",
+                UPDATE_DRAIN_TIMEOUT,
+                scheduler.unfinished,
+            )
+        try:
+            # Confirms only what finished, up to the oldest unfinished update; the rest (if the
+            # drain timed out) is delivered again after a restart
+            offset = scheduler.processed_offset
+            if offset is not None:
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+        except Exception as e:  # noqa
+            logging.error("Failed to confirm updates: %s", e)
+        try:
+            await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        finally:
+            await bot.session.close()
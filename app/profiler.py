@@ -0,0 +1,173 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+_SAMPLE_INTERVAL = 0.005
+_APP_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_ROOT_DIR = os.path.dirname(os.path.dirname(_APP_DIR)) + os.sep
+
+# "file:line function" of the innermost app frame a task is suspended in, followed by the
+# innermost frame overall when that is library code (what the app frame is really waiting on)
+Location = str
+
+
+class Report(NamedTuple):
+    duration: float
+    samples: int
+    stacks: Counter
+    waits: Dict[Location, List[float]]
+    steps: Dict[Location, List[float]]
+
+
+def _short_path(path: str) -> str:
+    if path.startswith(_ROOT_DIR):
+        return path[len(_ROOT_DIR):]
+    _, found, rest = path.rpartition("site-packages" + os.sep)
+    return rest if found else os.path.basename(path)
+
+
+def _frame_name(frame: FrameType) -> str:
+    return f"{_short_path(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def _collapse(frame: Optional[FrameType]) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _describe(frame: FrameType) -> str:
+    return f"{_short_path(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def _await_location(coro: Any) -> Optional[Location]:
+    # Follows the await chain down, remembering the innermost frame that belongs to the bot itself
+    app_frame = leaf = None
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is not None:
+            leaf = frame
+            if frame.f_code.co_filename.startswith(_APP_DIR):
+                app_frame = frame
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    if app_frame is None:
+        return None
+    if leaf is app_frame:
+        return _describe(app_frame)
+    return f"{_describe(app_frame)} -> {_describe(leaf)}"
+
+
+def _record(table: Dict[Location, List[float]], location: Location, elapsed: float) -> None:
+    # [count, total, max]
+    entry = table.get(location)
+    if entry is None:
+        table[location] = [1, elapsed, elapsed]
+    else:
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+
+# Samples the event loop thread's stack from a side thread, and while running wraps
+# Handle._run to time how long handler tasks sit at each await and how long each step blocks.
+class LoopProfiler:
+    def __init__(self) -> None:
+        self.running = False
+
+    async def run(self, duration: float) -> Report:
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        stacks: Counter = Counter()
+        waits: Dict[Location, List[float]] = {}
+        steps: Dict[Location, List[float]] = {}
+        suspended: Dict[asyncio.Task, Tuple[Location, float]] = {}
+        stop = threading.Event()
+        loop_thread = threading.get_ident()
+        # Our own sleep would otherwise top the await table
+        own_task = asyncio.current_task()
+        original_run = asyncio.events.Handle._run
+
+        def sample() -> None:
+            while not stop.wait(_SAMPLE_INTERVAL):
+                frame = sys._current_frames().get(loop_thread)
+                if frame is not None:
+                    stacks[_collapse(frame)] += 1
+
+        def timed_run(handle: asyncio.Handle) -> None:
+            task = getattr(handle._callback, "__self__", None)
+            if not isinstance(task, asyncio.Task) or task is own_task:
+                return original_run(handle)
+            started = time.perf_counter()
+            resumed = suspended.pop(task, None)
+            if resumed is not None:
+                _record(waits, resumed[0], started - resumed[1])
+            try:
+                return original_run(handle)
+            finally:
+                ended = time.perf_counter()
+                if resumed is not None:
+                    _record(steps, resumed[0], ended - started)
+                if not task.done():
+                    location = _await_location(task.get_coro())
+                    if location is not None:
+                        suspended[task] = (location, ended)
+
+        sampler = threading.Thread(target=sample, name="loop-profiler", daemon=True)
+        started = time.perf_counter()
+        asyncio.events.Handle._run = timed_run
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            asyncio.events.Handle._run = original_run
+            stop.set()
+            await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+            self.running = False
+        return Report(time.perf_counter() - started, sum(stacks.values()), stacks, waits, steps)
+
+
+def format_collapsed(report: Report) -> str:
+    # One "frame;frame;frame count" line per stack, the input format of flamegraph.pl and speedscope
+    return "".join(f"{stack} {count}\n" for stack, count in report.stacks.most_common())
+
+
+def _location_table(title: str, table: Dict[Location, List[float]], top: int) -> List[str]:
+    lines = [title, f"{'max ms':>10}{'avg ms':>10}{'count':>8}  location"]
+    for location, (count, total, longest) in sorted(table.items(), key=lambda item: -item[1][2])[:top]:
+        lines.append(f"{longest * 1000:>10.1f}{total / count * 1000:>10.2f}{count:>8}  {location}")
+    return lines
+
+
+def format_report(report: Report, top: int = 30) -> str:
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in report.stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    samples = report.samples or 1
+    lines = [
+        f"Duration: {report.duration:.1f}s, samples: {report.samples}",
+        "",
+        f"Hot functions (top {top} by own samples)",
+        f"{'own %':>8}{'total %':>9}  function",
+    ]
+    for name, count in own.most_common(top):
+        lines.append(f"{count / samples:>8.1%}{total[name] / samples:>9.1%}  {name}")
+    lines.append("")
+    lines.extend(_location_table(f"Slowest await points (top {top} by max wait)", report.waits, top))
+    lines.append("")
+    lines.extend(_location_table(f"Longest blocking steps after an await (top {top})", report.steps, top))
+    return "\n".join(lines) + "\n"
+
+
+profiler = LoopProfiler()
@@ -0,0 +1,59 @@
+import fcntl
+import glob
+import logging
+import os
+import time
+from contextlib import suppress
+from typing import List
+
+from app import db
+from app.config import BACKUP_DIR, BACKUP_INTERVAL, BACKUP_KEEP
+
+_PREFIX = "movies-"
+_SUFFIX = ".db"
+_LOCK = ".backup.lock"
+
+
+def _backups() -> List[str]:
+    # Oldest first; the timestamp in the name sorts chronologically
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, f"{_PREFIX}*{_SUFFIX}")))
+
+
+async def run_backup() -> str:
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, f"{_PREFIX}{time.strftime('%Y%m%d-%H%M%S')}{_SUFFIX}")
+    # Written under a temporary name so a half-finished copy never looks like a backup
+    partial = f"{path}.{os.getpid()}.partial"
+    started = time.perf_counter()
+    try:
+        await db.backup_database(partial)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    logging.info(
+        "Backed up the database to %s (%.1f MB) in %.1fs",
+        path,
+        os.path.getsize(path) / 1e6,
+        time.perf_counter() - started,
+    )
+    for old in _backups()[:-BACKUP_KEEP]:
+        # Another process may be pruning the same files
+        with suppress(FileNotFoundError):
+            os.remove(old)
+    return path
+
+
+async def scheduled_backup() -> None:
+    # Every worker runs this job; the lock lets one of them back up while the rest skip, and the
+    # age check stops restarts and the workers that get the lock afterwards from adding more
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    with open(os.path.join(BACKUP_DIR, _LOCK), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        backups = _backups()
+        if backups and time.time() - os.path.getmtime(backups[-1]) < BACKUP_INTERVAL * 0.9:
+            return
+        await run_backup()
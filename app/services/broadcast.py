@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from app import db
+from app.config import BROADCAST_CONCURRENCY, BROADCAST_LEASE, BROADCAST_PAGE_SIZE, BROADCAST_REPORT_INTERVAL
+from app.services.sender import background_priority
+
+_SENT, _FAILED, _BLOCKED = range(3)
+
+# broadcast id -> task sending it from this process
+_running: Dict[int, asyncio.Task] = {}
+
+
+def _lease() -> int:
+    return int(time.time() + BROADCAST_LEASE)
+
+
+async def _send(bot: Bot, broadcast: db.Broadcast, user_id: int, limit: asyncio.Semaphore) -> int:
+    async with limit:
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=broadcast.from_chat_id, message_id=broadcast.message_id)
+            return _SENT
+        except TelegramForbiddenError:
+            # Blocked the bot or deleted their account; they can't be messaged any more
+            return _BLOCKED
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                return _BLOCKED
+            logging.warning("Broadcast %s to %s failed: %s", broadcast.id, user_id, e)
+            return _FAILED
+        except Exception as e:  # noqa
+            logging.warning("Broadcast %s to %s failed: %s", broadcast.id, user_id, e)
+            return _FAILED
+
+
+def _progress(broadcast: db.Broadcast, done_this_run: int, elapsed: float) -> str:
+    done = broadcast.sent + broadcast.failed + broadcast.blocked
+    rate = done_this_run / elapsed if elapsed > 0 else 0.0
+    remaining = max(broadcast.total - done, 0)
+    eta = f"{remaining / rate / 60:.1f} min" if rate > 0 else "unknown"
+    return (
+        f"Broadcast #{broadcast.id}: {done}/{broadcast.total}\n"
+        f"- sent: {broadcast.sent}\n"
+        f"- blocked (removed): {broadcast.blocked}\n"
+        f"- failed: {broadcast.failed}\n"
+        f"- rate: {rate:.1f} msg/s\n"
+        f"- ETA: {eta}"
+    )
+
+
+async def _run(bot: Bot, broadcast: db.Broadcast) -> None:
+    limit = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    reported = started
+    done_this_run = 0
+    status = await bot.send_message(broadcast.admin_chat_id, _progress(broadcast, 0, 0), parse_mode=None)
+    while True:
+        user_ids = await db.users_after(broadcast.last_user_id, BROADCAST_PAGE_SIZE)
+        if not user_ids:
+            break
+        # Below interactive replies in the send queue, so users never wait behind a broadcast
+        with background_priority():
+            results = await asyncio.gather(*(_send(bot, broadcast, user_id, limit) for user_id in user_ids))
+        blocked: List[int] = [user_id for user_id, result in zip(user_ids, results) if result == _BLOCKED]
+        if blocked:
+            await db.remove_users(blocked)
+        done_this_run += len(user_ids)
+        broadcast = broadcast._replace(
+            last_user_id=user_ids[-1],
+            sent=broadcast.sent + results.count(_SENT),
+            failed=broadcast.failed + results.count(_FAILED),
+            blocked=broadcast.blocked + len(blocked),
+        )
+        # A crash after this point re-sends at most the current page
+        if not await db.checkpoint_broadcast(broadcast, _lease()):
+            await status.edit_text(
+                _progress(broadcast, done_this_run, time.monotonic() - started) + "\nStopped.", parse_mode=None
+            )
+            return
+        now = time.monotonic()
+        if now - reported >= BROADCAST_REPORT_INTERVAL:
+            reported = now
+            await status.edit_text(_progress(broadcast, done_this_run, now - started), parse_mode=None)
+    await db.finish_broadcast(broadcast.id)
+    await status.edit_text(
+        _progress(broadcast, done_this_run, time.monotonic() - started) + "\nDone.", parse_mode=None
+    )
+
+
+def _start(bot: Bot, broadcast: db.Broadcast) -> None:
+    task = asyncio.create_task(_run(bot, broadcast))
+    _running[broadcast.id] = task
+
+    def forget(t: asyncio.Task) -> None:
+        _running.pop(broadcast.id, None)
+        if not t.cancelled() and t.exception():
+            logging.error("Broadcast %s stopped: %s", broadcast.id, t.exception())
+
+    task.add_done_callback(forget)
+
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, from_chat_id: int, message_id: int) -> db.Broadcast:
+    broadcast = await db.create_broadcast(admin_chat_id, from_chat_id, message_id, _lease())
+    _start(bot, broadcast)
+    return broadcast
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    # Renews the leases of our own broadcasts (a slow page mustn't let another process take one
+    # over), then picks up broadcasts whose process went away
+    if _running:
+        await db.renew_broadcasts(list(_running), _lease())
+    for broadcast in await db.claim_broadcasts(_lease()):
+        if broadcast.id not in _running:
+            logging.info("Resuming broadcast %s after user %s", broadcast.id, broadcast.last_user_id)
+            _start(bot, broadcast)
+
+
+async def stop_running() -> None:
+    # On shutdown: leave the rows running with a lapsing lease so the next process resumes them
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
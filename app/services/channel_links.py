@@ -10,28 +10,28 @@ class ChannelLinkService:
     async def add_channel(self, chat_id: int, invite_link: str):
         # Validate access using chat_id (invite links may not resolve via API)
         await self.bot.get_chat(chat_id)
-        created = db.add_channel(invite_link=invite_link, chat_id=chat_id)
+        created = await db.add_channel(invite_link=invite_link, chat_id=chat_id)
         if not created:
             raise ValueError("Channel already exists.")
         return invite_link, chat_id
 
     @staticmethod
     async def refresh_invite(invite_link: str):
-        channel = db.get_channel(invite_link)
+        channel = await db.get_channel(invite_link)
         if not channel:
             raise ValueError("Channel not found.")
         return channel.invite_link
 
     @staticmethod
     async def remove_channel(invite_link: str):
-        channel = db.get_channel(invite_link)
+        channel = await db.get_channel(invite_link)
         if not channel:
             raise ValueError("Channel not found.")
-        removed = db.remove_channel(invite_link)
+        removed = await db.remove_channel(invite_link)
         if not removed:
             raise ValueError("Failed to remove channel.")
         return True
 
     @staticmethod
-    def list_channels():
-        return db.list_channels()
+    async def list_channels():
+        return await db.list_channels()
@@ -0,0 +1,259 @@
+import asyncio
+import csv
+import json
+import logging
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, TextIO, Tuple, Union
+
+from aiogram import Bot
+
+from app import db
+from app.config import IMPORT_LEASE, STORAGE_CHANNEL_ID
+from app.formatting import render_captions
+from app.keyboards import delete_button_keyboard
+from app.services.sender import background_priority
+
+_JSONL_SUFFIXES = (".jsonl", ".ndjson", ".json")
+# Rows published between checkpoints; a crash re-posts at most this many
+_PUBLISH_BATCH = 20
+_MAX_REPORTED_PROBLEMS = 20
+
+
+class ImportRow(NamedTuple):
+    code: str
+    file_id: Optional[str]
+    storage_message_id: Optional[int]
+    name: str
+    description: str
+
+
+# A later part of a multi-part title, as written by /export to movie_parts-*.jsonl.gz
+class PartRow(NamedTuple):
+    code: str
+    part: int
+    file_id: str
+    storage_message_id: Optional[int]
+
+
+def _read_records(stream: TextIO, filename: str) -> Iterator[Tuple[int, Any]]:
+    if filename.lower().endswith(_JSONL_SUFFIXES):
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError:
+                yield line_no, None
+    else:
+        reader = csv.DictReader(stream)
+        for raw in reader:
+            yield reader.line_num, raw
+
+
+def _parse_int(raw: Dict[str, Any], field: str) -> Optional[int]:
+    value = raw.get(field)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be an integer")
+
+
+def _parse_part(raw: Dict[str, Any], code: str) -> PartRow:
+    part = _parse_int(raw, "part")
+    # Part 1 is the movie's own file_id
+    if part is None or part < 2:
+        raise ValueError("part must be 2 or more")
+    file_id = str(raw.get("file_id") or "").strip()
+    if not file_id:
+        raise ValueError("missing file_id")
+    return PartRow(code, part, file_id, _parse_int(raw, "storage_message_id"))
+
+
+def _parse_row(raw: Any) -> Union[ImportRow, PartRow]:
+    if not isinstance(raw, dict):
+        raise ValueError("not a valid record")
+    code = str(raw.get("code") or "").strip()
+    if not code:
+        raise ValueError("missing code")
+    if raw.get("part") not in (None, ""):
+        return _parse_part(raw, code)
+    file_id = str(raw.get("file_id") or "").strip() or None
+    storage_message_id = _parse_int(raw, "storage_message_id")
+    if not file_id and storage_message_id is None:
+        raise ValueError("either file_id or storage_message_id is required")
+    name = str(raw.get("name") or "").strip()
+    description = str(raw.get("description") or "").strip()
+    return ImportRow(code, file_id, storage_message_id, name, description)
+
+
+def read_import(stream: TextIO, filename: str) -> Tuple[List[ImportRow], List[PartRow], List[str]]:
+    rows: List[ImportRow] = []
+    parts: List[PartRow] = []
+    problems: List[str] = []
+    seen: Dict[str, int] = {}
+    seen_parts: Dict[Tuple[str, int], int] = {}
+    for line_no, raw in _read_records(stream, filename):
+        try:
+            row = _parse_row(raw)
+        except ValueError as exc:
+            problems.append(f"line {line_no}: {exc}")
+            continue
+        if isinstance(row, PartRow):
+            key = (row.code, row.part)
+            if key in seen_parts:
+                first = seen_parts[key]
+                problems.append(f"line {line_no}: duplicate part {row.part} of {row.code} (first on line {first})")
+                continue
+            seen_parts[key] = line_no
+            parts.append(row)
+            continue
+        if row.code in seen:
+            problems.append(f"line {line_no}: duplicate code {row.code} (first on line {seen[row.code]})")
+            continue
+        seen[row.code] = line_no
+        rows.append(row)
+    return rows, parts, problems
+
+
+def format_problems(problems: List[str]) -> str:
+    lines = problems[:_MAX_REPORTED_PROBLEMS]
+    if len(problems) > len(lines):
+        lines.append(f"... and {len(problems) - len(lines)} more")
+    return "\n".join(lines)
+
+
+async def _resolve_file_id(bot: Bot, chat_id: int, storage_message_id: int) -> Optional[str]:
+    # The Bot API has no "get message", so forward the post to the admin and read the video back
+    forwarded = await bot.forward_message(chat_id=chat_id, from_chat_id=STORAGE_CHANNEL_ID, message_id=storage_message_id)
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=forwarded.message_id)
+    except Exception:  # noqa
+        pass
+    return forwarded.video.file_id if forwarded.video else None
+
+
+def _lease() -> int:
+    return int(time.time() + IMPORT_LEASE)
+
+
+def _add_problems(job: db.Import, problems: List[str]) -> db.Import:
+    # Only the first few are kept for the report; the rest are counted
+    room = _MAX_REPORTED_PROBLEMS - len(job.problems)
+    return job._replace(
+        problems=job.problems + tuple(problems[:max(room, 0)]),
+        problem_count=job.problem_count + len(problems),
+    )
+
+
+async def _publish_row(
+    bot: Bot, job: db.Import, row: ImportRow
+) -> Tuple[Optional[ImportRow], Optional[int], Optional[str]]:
+    # Returns (row resolved from storage, new storage message id, problem)
+    if row.file_id is None:
+        try:
+            file_id = await _resolve_file_id(bot, job.admin_chat_id, row.storage_message_id)
+        except Exception as exc:  # noqa
+            return None, None, f"{row.code}: cannot read storage message {row.storage_message_id} ({exc})"
+        if not file_id:
+            return None, None, f"{row.code}: storage message {row.storage_message_id} has no video"
+        return row._replace(file_id=file_id), None, None
+    try:
+        sent = await bot.send_video(
+            chat_id=STORAGE_CHANNEL_ID,
+            video=row.file_id,
+            caption=render_captions(row.code, row.name, row.description)[1],
+            reply_markup=delete_button_keyboard(row.code),
+        )
+    except Exception as exc:  # noqa
+        return None, None, f"{row.code}: storage post failed ({exc})"
+    return None, sent.message_id, None
+
+
+async def _publish(bot: Bot, job: db.Import) -> None:
+    while True:
+        rows = [ImportRow._make(row) for row in await db.pending_import_rows(job.id, _PUBLISH_BATCH)]
+        if not rows:
+            break
+        problems: List[str] = []
+        resolved: List[ImportRow] = []
+        storage_ids: List[Tuple[int, str]] = []
+        with background_priority():
+            for row in rows:
+                resolved_row, message_id, problem = await _publish_row(bot, job, row)
+                if resolved_row is not None:
+                    resolved.append(resolved_row)
+                if message_id is not None:
+                    storage_ids.append((message_id, row.code))
+                if problem is not None:
+                    problems.append(problem)
+        job = _add_problems(job, problems)._replace(
+            resolved=job.resolved + len(resolved), posted=job.posted + len(storage_ids)
+        )
+        conflicts = await db.checkpoint_import(job, [row.code for row in rows], resolved, storage_ids, _lease())
+        # Saved with the next batch
+        if conflicts:
+            job = _add_problems(job, [f"{code}: code already exists" for code in conflicts])
+            job = job._replace(resolved=job.resolved - len(conflicts))
+    await db.finish_import(job)
+    text = f"Import finished: {job.resolved} rows resolved from storage, {job.posted} storage posts."
+    if job.problem_count:
+        lines = list(job.problems)
+        if job.problem_count > len(lines):
+            lines.append(f"... and {job.problem_count - len(lines)} more")
+        text += "\n\n" + "\n".join(lines)
+    await bot.send_message(job.admin_chat_id, text, parse_mode=None)
+
+
+# import id -> task publishing it from this process
+_running: Dict[int, asyncio.Task] = {}
+
+
+def _start(bot: Bot, job: db.Import) -> None:
+    task = asyncio.create_task(_publish(bot, job))
+    _running[job.id] = task
+
+    def forget(t: asyncio.Task) -> None:
+        _running.pop(job.id, None)
+        if not t.cancelled() and t.exception():
+            logging.error("Import %s stopped: %s", job.id, t.exception())
+
+    task.add_done_callback(forget)
+
+
+async def import_movies(bot: Bot, chat_id: int, rows: List[ImportRow]) -> Tuple[int, List[str], int]:
+    ready = [row for row in rows if row.file_id]
+    # Storage posts and lookups are rate limited, so they continue after the admin gets the report.
+    # They are recorded with the import, so a restart resumes them instead of dropping them.
+    pending = [row for row in rows if not row.file_id or row.storage_message_id is None]
+    conflicts, job = await db.start_import(chat_id, ready, pending, _lease())
+    if job is not None:
+        _start(bot, job)
+    return len(ready) - len(conflicts), conflicts, job.total if job else 0
+
+
+async def resume_imports(bot: Bot) -> None:
+    # Renews the leases of our own imports, then picks up imports whose process went away
+    if _running:
+        await db.renew_imports(list(_running), _lease())
+    for job in await db.claim_imports(_lease()):
+        if job.id not in _running:
+            logging.info("Resuming import %s (%s of %s rows done)", job.id, job.resolved + job.posted, job.total)
+            _start(bot, job)
+
+
+async def stop_running() -> None:
+    # On shutdown: leave the rows running with a lapsing lease so the next process resumes them
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def import_parts(parts: List[PartRow]) -> Tuple[int, List[str]]:
+    # Runs after the movies in the same file (or an earlier /import) are inserted
+    unknown, conflicts = await db.import_movie_parts(parts)
+    problems = [f"{code}: no such movie for its parts" for code in dict.fromkeys(unknown)]
+    problems.extend(f"{code}: part {part} already exists" for code, part in conflicts)
+    return len(parts) - len(unknown) - len(conflicts), problems
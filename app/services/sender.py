@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from app.cache import LRUCache
+from app.config import SEND_CHAT_RATE, SEND_GLOBAL_RATE, SEND_GROUP_RATE, WORKERS
+from app.ratelimit import TokenBucket
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=INTERACTIVE)
+
+_LIMITED_PREFIXES = ("send", "copy", "forward")
+_MAX_TRACKED_CHATS = 10000
+# This many chats flood-waited within the window means the limit is the bot's, not theirs
+_FLOOD_WINDOW = 1.0
+_FLOOD_CHATS = 3
+
+
+def is_rate_limited(method: TelegramMethod) -> bool:
+    # Methods that post a message count against Telegram's send limits; answers and edits don't
+    return method.__api_method__.startswith(_LIMITED_PREFIXES)
+
+
+@contextmanager
+def background_priority():
+    token = send_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+# Session middleware that funnels every outgoing message through Telegram's limits: a per-chat
+# bucket first, then a shared global bucket whose waiters are served by priority.
+class SendScheduler(BaseRequestMiddleware):
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = LRUCache(_MAX_TRACKED_CHATS)
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        # (time, chat id) of recent 429s
+        self._floods: Deque[Tuple[float, int]] = deque()
+        self.chat_waiting = 0
+        self.granted = 0
+        self.sent = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, 1)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    def _flood_wait(self, chat_id: Optional[int], retry_after: float) -> None:
+        if not isinstance(chat_id, int):
+            self._global.pause(retry_after)
+            return
+        self._chat_bucket(chat_id).pause(retry_after)
+        now = time.monotonic()
+        self._floods.append((now, chat_id))
+        while self._floods[0][0] < now - _FLOOD_WINDOW:
+            self._floods.popleft()
+        if len({chat for _, chat in self._floods}) >= _FLOOD_CHATS:
+            self._global.pause(retry_after)
+
+    async def _pump(self) -> None:
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if self._queue[0][2].done():
+                # Waiter was cancelled; don't spend a token on it
+                heapq.heappop(self._queue)
+                continue
+            if not self._global.take():
+                await asyncio.sleep(self._global.delay())
+                continue
+            _, _, waiter = heapq.heappop(self._queue)
+            waiter.set_result(None)
+
+    async def _acquire(self, chat_id: Optional[int]) -> None:
+        if self._pump_task is None:
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        started = time.monotonic()
+        if isinstance(chat_id, int):
+            self.chat_waiting += 1
+            try:
+                await self._chat_bucket(chat_id).acquire()
+            finally:
+                self.chat_waiting -= 1
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (send_priority.get(), next(self._seq), waiter))
+        self._wakeup.set()
+        await waiter
+        waited = time.monotonic() - started
+        self.granted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        if not is_rate_limited(method):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        while True:
+            await self._acquire(chat_id)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retries += 1
+                # A lone 429 stalls its chat; several chats at once, or no chat, stall everyone
+                self._flood_wait(chat_id, e.retry_after)
+                continue
+            self.sent += 1
+            return response
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queued": len(self._queue),
+            "chat_waiting": self.chat_waiting,
+            "sent": self.sent,
+            "retries": self.retries,
+            "avg_wait": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+# Telegram's global limit applies to the bot token, so worker processes split it
+send_scheduler = SendScheduler(
+    global_rate=SEND_GLOBAL_RATE / max(WORKERS, 1),
+    chat_rate=SEND_CHAT_RATE,
+    group_rate=SEND_GROUP_RATE,
+)
@@ -0,0 +1,35 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, TypeVar
+
+T = TypeVar("T")
+
+
+# Concurrent calls with the same key share one in-flight task instead of repeating the work.
+# The task is cancelled only when every caller waiting on it has gone away.
+class SingleFlight:
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, List] = {}  # key -> [task, waiters]
+        self.started = 0
+        self.shared = 0
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        call = self._calls.get(key)
+        if call is not None and call[0] is task:
+            del self._calls[key]
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(func())
+            task.add_done_callback(lambda t: self._forget(key, t))
+            call = self._calls[key] = [task, 0]
+            self.started += 1
+        else:
+            self.shared += 1
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if not call[1] and not call[0].done():
+                call[0].cancel()
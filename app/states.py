@@ -6,3 +6,7 @@ class AddMovie(StatesGroup):
     waiting_for_name = State()
     waiting_for_description = State()
     waiting_for_code = State()
+
+
+class ImportMovies(StatesGroup):
+    waiting_for_file = State()
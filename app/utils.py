@@ -1,52 +1,104 @@
+import asyncio
 import logging
+from typing import List, Sequence, TypeVar
 
 from aiogram import Bot
 from aiogram.enums import ChatMemberStatus
 
 from app import db
-from app.config import ADMIN_IDS
+from app.cache import TTLCache
+from app.config import ADMIN_IDS, MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CHECK_TIMEOUT
+from app.singleflight import SingleFlight
+
+# (user_id, chat_id) -> bool; kept fresh by the chat_member / chat_join_request handlers
+membership_cache = TTLCache(ttl=MEMBERSHIP_CACHE_TTL, maxsize=MEMBERSHIP_CACHE_SIZE)
+# (user_id, chat_id) -> in-flight get_chat_member, shared by repeated presses and resent codes
+member_checks = SingleFlight()
+
+
+_ALLOWED_STATUSES = {
+    ChatMemberStatus.MEMBER,
+    ChatMemberStatus.ADMINISTRATOR,
+    ChatMemberStatus.CREATOR,
+    ChatMemberStatus.RESTRICTED,
+}
+
+
+# Telegram's limit on the number of items in one sendMediaGroup
+MEDIA_GROUP_MAX = 10
+
+T = TypeVar("T")
 
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
+def media_group_chunks(items: Sequence[T]) -> List[Sequence[T]]:
+    # As few groups as possible, evenly sized so none is left with a single item (11 -> 6 + 5)
+    count = -(-len(items) // MEDIA_GROUP_MAX)
+    size, extra = divmod(len(items), count) if count else (0, 0)
+    chunks, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+async def _get_member_status(bot: Bot, chat_id: int, user_id: int) -> str:
+    member = await asyncio.wait_for(
+        bot.get_chat_member(chat_id=chat_id, user_id=user_id),
+        timeout=MEMBERSHIP_CHECK_TIMEOUT,
+    )
+    return member.status
+
+
 async def is_member(bot: Bot, user_id: int) -> bool:
-    channels = db.list_channels()
+    channels = await db.list_channels()
     if not channels:
         return True
-    allowed_statuses = {
-        ChatMemberStatus.MEMBER,
-        ChatMemberStatus.ADMINISTRATOR,
-        ChatMemberStatus.CREATOR,
-        ChatMemberStatus.RESTRICTED,
-    }
+    unknown = []
     for channel in channels:
-        try:
-            member = await bot.get_chat_member(chat_id=channel.chat_id, user_id=user_id)
-        except Exception as e:
-            logging.error(e)
-            if db.has_pending_join_request(user_id, channel.chat_id):
-                continue
+        cached = membership_cache.get((user_id, channel.chat_id))
+        if cached is None:
+            unknown.append(channel.chat_id)
+        elif not cached:
             return False
-        if member.status in allowed_statuses:
-            continue
-        if db.has_pending_join_request(user_id, channel.chat_id):
-            continue
-        return False
-    return True
-
-
-def escape_md(text: str) -> str:
-    for ch in "_*[]()~`>#+-=|{}.!":
-        text = text.replace(ch, f"\\{ch}")
-    return text
-
-
-def format_caption(name: str, description: str, code: str | None = None) -> str:
-    safe_name = escape_md(name)
-    safe_desc = escape_md(description)
-    caption = f"*{safe_name}*\n{safe_desc}"
-    if code:
-        caption += f"\n`{escape_md(code)}`"
-    return caption
\ No newline at end of file
+    if not unknown:
+        return True
+    # A pending join request makes the user eligible regardless of the API answer
+    pending = await db.pending_join_requests(user_id, unknown)
+    for chat_id in pending:
+        membership_cache.set((user_id, chat_id), True)
+    tasks = {
+        asyncio.create_task(
+            member_checks.do((user_id, chat_id), lambda chat_id=chat_id: _get_member_status(bot, chat_id, user_id))
+        ): chat_id
+        for chat_id in unknown
+        if chat_id not in pending
+    }
+    in_flight = set(tasks)
+    try:
+        while in_flight:
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                chat_id = tasks[task]
+                try:
+                    status = task.result()
+                except Exception as e:
+                    # Errors and timeouts reject without caching the verdict
+                    logging.error(e)
+                    return False
+                allowed = status in _ALLOWED_STATUSES
+                membership_cache.set((user_id, chat_id), allowed)
+                if not allowed:
+                    return False
+        return True
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Mark results we returned early without reading as retrieved
+                task.exception()
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from app.config import WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL
+from app.services.sender import is_rate_limited
+
+
+async def _register_webhook(bot: Bot, dispatcher: Dispatcher):
+    # Without a public URL the server still accepts POSTed updates, which is handy for local testing
+    if not WEBHOOK_URL:
+        logging.warning("WEBHOOK_URL is not set; not registering the webhook with Telegram")
+        return
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+    )
+
+
+# A method returned by a handler (e.g. `return callback.answer()`) goes back in the webhook response,
+# saving an API call. That skips the session middlewares, so methods that post messages (movie
+# delivery, `return message.answer(...)`) are called through the session instead, where the send
+# scheduler keeps them under Telegram's rate limits.
+class _SessionRequestHandler(SimpleRequestHandler):
+    async def _handle_request(self, bot: Bot, request: web.Request) -> web.Response:
+        result = await self.dispatcher.feed_webhook_update(
+            bot,
+            await request.json(loads=bot.session.json_loads),
+            **self.data,
+        )
+        if isinstance(result, TelegramMethod) and is_rate_limited(result):
+            await self.dispatcher.silent_call_request(bot=bot, result=result)
+            result = None
+        return web.Response(body=self._build_response_writer(bot=bot, result=result))
+
+
+def build_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    # Handle updates inline so Telegram only gets its answer (and stops retrying) once the update is done
+    _SessionRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=False,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    dp.startup.register(_register_webhook)
+    runner = web.AppRunner(build_app(dp, bot))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logging.info("Webhook server listening on %s:%s%s", WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Stops accepting connections, waits for in-flight updates, then runs the shutdown hooks.
+        # The webhook stays registered so Telegram queues updates for the next instance.
+        await runner.cleanup()
@@ -0,0 +1,220 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+from contextlib import suppress
+from typing import Any, Callable, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from app import db, metrics
+from app.config import (
+    BOT_MODE,
+    CACHE_SYNC_INTERVAL,
+    METRICS_HOST,
+    METRICS_PORT,
+    UPDATE_CONCURRENCY,
+    UPDATE_DRAIN_TIMEOUT,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_TYPE_LIMITS,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WORKERS,
+)
+from app.polling import UpdateScheduler
+
+_VIRTUAL_NODES = 64
+# Batches waiting per worker; once a worker's scheduler is full these fill up and the ingress stops
+_INGRESS_QUEUE_BATCHES = 4
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes: int, virtual_nodes: int = _VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}:{idx}"), node) for node in range(nodes) for idx in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: int) -> int:
+        idx = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._nodes[idx]
+
+
+def update_user_id(update: Dict[str, Any]) -> int:
+    # Membership events are keyed by the affected user so they land on the worker holding their cache
+    if "chat_member" in update:
+        return update["chat_member"]["new_chat_member"]["user"]["id"]
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+# Workers
+
+async def _sync_caches():
+    while True:
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+        try:
+            await db.sync_external_changes()
+        except Exception as e:  # noqa
+            logging.error(e)
+
+
+async def _serve(
+    index: int,
+    updates: multiprocessing.Queue,
+    create_bot: Callable[[], Bot],
+    create_dispatcher: Callable[[], Dispatcher],
+):
+    bot = create_bot()
+    dp = create_dispatcher()
+    loop = asyncio.get_running_loop()
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    sync_task = asyncio.create_task(_sync_caches())
+    metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT + index) if METRICS_PORT else None
+    # Same scheduling as single-process polling; ordered so each user sees their replies in order
+    scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_QUEUE_SIZE, UPDATE_TYPE_LIMITS, ordered=True)
+    dispatching = asyncio.create_task(scheduler.run(dp, bot, bots=[bot]))
+    logging.info("Worker %s started", index)
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, updates.get)
+            if batch is None:
+                break
+            for update in batch:
+                # Waits while the scheduler is full, which leaves the ingress queue to fill up
+                await scheduler.put(Update.model_validate(update, context={"bot": bot}))
+        await scheduler.close()
+        try:
+            await asyncio.wait_for(dispatching, UPDATE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(
+                "Worker %s gave up on %s updates after %ss", index, scheduler.unfinished, UPDATE_DRAIN_TIMEOUT
+            )
+    finally:
+        dispatching.cancel()
+        sync_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        try:
+            await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        finally:
+            await bot.session.close()
+        logging.info("Worker %s stopped", index)
+
+
+def _worker_main(index: int, updates: multiprocessing.Queue, create_bot, create_dispatcher):
+    # The ingress owns shutdown and tells workers to drain through the queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"%(levelname)s:worker-{index}:%(name)s:%(message)s")
+    asyncio.run(_serve(index, updates, create_bot, create_dispatcher))
+
+
+# Ingress
+
+class _Router:
+    def __init__(self, queues: List[multiprocessing.Queue]):
+        self.queues = queues
+        self.ring = HashRing(len(queues))
+
+    async def route(self, updates: List[Dict[str, Any]]) -> None:
+        batches: Dict[int, List[Dict[str, Any]]] = {}
+        for update in updates:
+            batches.setdefault(self.ring.node_for(update_user_id(update)), []).append(update)
+        loop = asyncio.get_running_loop()
+        for node, batch in batches.items():
+            # Blocks (off the loop) while that worker is backed up; fetching waits with it
+            await loop.run_in_executor(None, self.queues[node].put, batch)
+
+
+async def _poll(bot: Bot, router: _Router, allowed_updates: List[str], stop: asyncio.Event):
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:  # noqa
+            logging.error(e)
+            await asyncio.sleep(1)
+            continue
+        if not updates:
+            continue
+        await router.route([update.model_dump(mode="json", exclude_none=True) for update in updates])
+        offset = updates[-1].update_id + 1
+
+
+async def _serve_webhook(bot: Bot, router: _Router, allowed_updates: List[str], stop: asyncio.Event):
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(body="Unauthorized", status=401)
+        await router.route([await request.json()])
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_workers(create_bot: Callable[[], Bot], create_dispatcher: Callable[[], Dispatcher]):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(_INGRESS_QUEUE_BATCHES) for _ in range(WORKERS)]
+    processes = [
+        ctx.Process(target=_worker_main, args=(idx, queues[idx], create_bot, create_dispatcher), name=f"worker-{idx}")
+        for idx in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+
+    bot = create_bot()
+    dp = create_dispatcher()
+    allowed_updates = dp.resolve_used_update_types()
+    await dp.storage.close()
+    router = _Router(queues)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    ingress = _serve_webhook if BOT_MODE == "webhook" else _poll
+    task = asyncio.create_task(ingress(bot, router, allowed_updates, stop))
+    logging.info("Routing updates to %s workers", WORKERS)
+    try:
+        await stop.wait()
+    finally:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+        for q in queues:
+            await loop.run_in_executor(None, q.put, None)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        await bot.session.close()
@@ -0,0 +1,154 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import random
+import time
+from collections import Counter
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+# User ids at or above this are reported as non-members by getChatMember
+NON_MEMBER_BASE = 1_000_000_000
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def _message(message_id: int, chat_id: int, **extra: Any) -> Dict[str, Any]:
+    chat_type = "private" if chat_id > 0 else "channel"
+    return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": chat_type}, **extra}
+
+
+# Minimal stand-in for the Bot API: long-polled getUpdates fed by push(), canned answers for
+# the methods the bot calls, configurable latency and 429 injection on send* methods.
+# Every successful send* is reported to on_send with the target chat and time.monotonic().
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        self.on_send: Optional[Callable[[int, float], None]] = None
+        self._updates: List[Dict[str, Any]] = []
+        self._message_ids = itertools.count(1)
+        self._has_updates = asyncio.Event()
+
+    def push(self, update: Dict[str, Any]) -> None:
+        self._updates.append(update)
+        self._has_updates.set()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.startswith("send") and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                },
+                status=429,
+            )
+        result = self._answer(method, params)
+        if method.startswith(("send", "copy", "forward")) and self.on_send is not None:
+            self.on_send(int(params["chat_id"]), time.monotonic())
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        return self._updates[:limit]
+
+    def _answer(self, method: str, params: Dict[str, str]) -> Any:
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "left" if user_id >= NON_MEMBER_BASE else "member"
+            return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        if method == "getChat":
+            return {"id": int(params["chat_id"]), "type": "channel", "title": "Bench"}
+        if method == "sendVideo":
+            video = {"file_id": params["video"], "file_unique_id": "u", "width": 1, "height": 1, "duration": 1}
+            return _message(next(self._message_ids), int(params["chat_id"]), video=video)
+        if method == "sendMediaGroup":
+            return [_message(next(self._message_ids), int(params["chat_id"])) for _ in json.loads(params["media"])]
+        if method.startswith(("send", "forward")):
+            return _message(next(self._message_ids), int(params["chat_id"]))
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        return True
+
+
+async def serve(api: FakeBotAPI, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def _run(conn: Connection, updates: multiprocessing.Queue, sends: multiprocessing.Queue, options: Dict[str, Any]) -> None:
+    async def main() -> None:
+        api = FakeBotAPI(**options)
+        api.on_send = lambda chat_id, at: sends.put((chat_id, at))
+        runner = await serve(api)
+        conn.send(runner.addresses[0][1])
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await loop.run_in_executor(None, updates.get)
+            if batch is None:
+                break
+            for update in batch:
+                api.push(update)
+        await runner.cleanup()
+        sends.put(None)
+        conn.send((dict(api.calls), api.rate_limited))
+
+    asyncio.run(main())
+
+
+# Runs the fake API in its own process so it does not compete with the bot for the event loop.
+# Updates go in through `updates` (lists of update dicts, None to stop); sends come back on `sends`.
+class FakeBotAPIProcess:
+    def __init__(self, **options: Any):
+        context = multiprocessing.get_context("spawn")
+        self.updates = context.Queue()
+        self.sends = context.Queue()
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=_run, args=(child, self.updates, self.sends, options), daemon=True)
+
+    def start(self) -> int:
+        self._process.start()
+        return self._conn.recv()
+
+    def push(self, update: Dict[str, Any]) -> None:
+        self.updates.put([update])
+
+    def stop(self) -> Tuple[Dict[str, int], int]:
+        self.updates.put(None)
+        stats = self._conn.recv()
+        self._process.join()
+        return stats
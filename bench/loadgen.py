@@ -0,0 +1,343 @@
+"""End-to-end load benchmark.
+
+Starts a fake Bot API on localhost, points the real bot from main.py at it and long-polls a
+weighted mix of updates through the dispatcher, then reports p50/p99 latency per scenario and
+overall updates/sec. Results are saved under bench/results/ and compared to the previous run.
+
+    python -m bench.loadgen --updates 5000 --rate 500 --latency-ms 20 --rate-limit-ratio 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import itertools
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from bench.fake_api import NON_MEMBER_BASE, FakeBotAPIProcess
+
+RESULTS_DIR = Path(__file__).parent / "results"
+STORAGE_CHANNEL_ID = -1000000000001
+CHANNEL_IDS = [-1000000000011, -1000000000012, -1000000000013]
+ADMIN_BASE = 900_000_000
+MIX = {
+    "valid_code": 60,
+    "invalid_code": 10,
+    "title_search": 5,
+    "non_member": 10,
+    "join_request": 15,
+}
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Tracker:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self._by_chat: Dict[int, Deque[Tuple[str, float, asyncio.Future]]] = defaultdict(deque)
+        self._by_update: Dict[int, Tuple[str, float, asyncio.Future]] = {}
+        self.first_start: Optional[float] = None
+        self.last_done = 0.0
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+
+    def start(self, label: str, chat_id: Optional[int], update_id: Optional[int] = None) -> asyncio.Future:
+        # time.monotonic() is system-wide, so it compares with the fake API's send times
+        now = time.monotonic()
+        if self.first_start is None:
+            self.first_start = now
+        entry = (label, now, asyncio.get_running_loop().create_future())
+        if chat_id is not None:
+            self._by_chat[chat_id].append(entry)
+        else:
+            self._by_update[update_id] = entry
+        return entry[2]
+
+    def _finish(self, entry: Tuple[str, float, asyncio.Future], at: float) -> None:
+        label, started, future = entry
+        self.last_done = max(self.last_done, at)
+        self.latencies[label].append(at - started)
+        if not future.done():
+            future.set_result(None)
+
+    def on_send(self, chat_id: int, at: float) -> None:
+        pending = self._by_chat.get(chat_id)
+        if pending:
+            self._finish(pending.popleft(), at)
+
+    def on_processed(self, update_id: int) -> None:
+        entry = self._by_update.pop(update_id, None)
+        if entry is not None:
+            self._finish(entry, time.monotonic())
+
+    async def middleware(self, handler, event, data):
+        self.in_flight += 1
+        self.idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.set()
+            self.on_processed(event.update_id)
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": "User"}
+
+
+def _message(user_id: int, **content: Any) -> Dict[str, Any]:
+    return {
+        "message": {
+            "message_id": random.randint(1, 1 << 30),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            **content,
+        }
+    }
+
+
+def _join_request(user_id: int) -> Dict[str, Any]:
+    return {
+        "chat_join_request": {
+            "chat": {"id": random.choice(CHANNEL_IDS), "type": "channel", "title": "Bench"},
+            "from": _user(user_id),
+            "user_chat_id": user_id,
+            "date": int(time.time()),
+        }
+    }
+
+
+class LoadGenerator:
+    def __init__(self, api: FakeBotAPIProcess, tracker: Tracker, args: argparse.Namespace, codes: List[str]):
+        self.api = api
+        self.update_ids = itertools.count(1)
+        self.tracker = tracker
+        self.args = args
+        self.codes = codes
+        self.labels, self.weights = zip(*MIX.items())
+
+    def _update(self, label: str) -> Tuple[Dict[str, Any], Optional[int]]:
+        member = random.randint(1, self.args.users)
+        if label == "valid_code":
+            return _message(member, text=random.choice(self.codes)), member
+        if label == "invalid_code":
+            return _message(member, text=str(random.randint(10**8, 10**9))), member
+        if label == "title_search":
+            return _message(member, text=f"movie {random.randint(1, len(self.codes))}"), member
+        if label == "non_member":
+            user_id = NON_MEMBER_BASE + member
+            return _message(user_id, text=random.choice(self.codes)), user_id
+        return _join_request(NON_MEMBER_BASE + random.randint(1, 10**6)), None
+
+    def _push(self, label: str, update: Dict[str, Any], chat_id: Optional[int]) -> asyncio.Future:
+        # Replies are matched to the oldest pending update of their chat; updates without a
+        # reply (join requests) complete when the dispatcher is done with their update id
+        update_id = next(self.update_ids)
+        future = self.tracker.start(label, chat_id, update_id)
+        self.api.push({"update_id": update_id, **update})
+        return future
+
+    async def users(self) -> List[asyncio.Future]:
+        futures = []
+        interval = 1 / self.args.rate
+        started = time.perf_counter()
+        for index in range(self.args.updates):
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            label = random.choices(self.labels, self.weights)[0]
+            futures.append(self._push(label, *self._update(label)))
+        return futures
+
+    async def admin_flow(self, admin_id: int, index: int) -> None:
+        video = {"file_id": f"bench-upload-{admin_id}-{index}", "file_unique_id": "u", "width": 1, "height": 1, "duration": 1}
+        steps = [
+            ("admin_add:start", {"text": "/add", "entities": [{"type": "bot_command", "offset": 0, "length": 4}]}),
+            ("admin_add:video", {"video": video}),
+            ("admin_add:name", {"text": f"Bench upload {admin_id} {index}"}),
+            ("admin_add:description", {"text": "Added by the load benchmark"}),
+            ("admin_add:code", {"text": f"9{admin_id % 1000:03d}{index:05d}"}),
+        ]
+        for label, content in steps:
+            await self._push(label, _message(admin_id, **content), admin_id)
+
+    async def admins(self) -> None:
+        async def run(admin_id: int) -> None:
+            for index in range(self.args.admin_flows):
+                await self.admin_flow(admin_id, index)
+
+        await asyncio.gather(*(run(ADMIN_BASE + n) for n in range(self.args.admins)))
+
+
+async def _seed(db, movies: int) -> List[str]:
+    rows = [
+        (str(100000 + n), f"bench-file-{n}", n + 1, f"Movie {n} {random.choice(['Night', 'River', 'Star'])}", "Bench")
+        for n in range(movies)
+    ]
+    await db.import_movies(rows)
+    for chat_id in CHANNEL_IDS:
+        await db.add_channel(f"https://t.me/+bench{abs(chat_id)}", chat_id)
+    return [row[0] for row in rows]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _forward_sends(api: FakeBotAPIProcess, tracker: Tracker, loop: asyncio.AbstractEventLoop) -> None:
+    for chat_id, at in iter(api.sends.get, None):
+        loop.call_soon_threadsafe(tracker.on_send, chat_id, at)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    api = FakeBotAPIProcess(
+        latency=args.latency_ms / 1000, rate_limit_ratio=args.rate_limit_ratio, retry_after=args.retry_after
+    )
+    port = api.start()
+
+    workdir = tempfile.mkdtemp(prefix="kino-bench-")
+    os.environ.update(
+        {
+            "BOT_TOKEN": "123456:bench",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{port}",
+            "STORAGE_CHANNEL_ID": str(STORAGE_CHANNEL_ID),
+            "ADMIN_IDS": ",".join(str(ADMIN_BASE + n) for n in range(max(args.admins, 1))),
+            "DB_PATH": os.path.join(workdir, "movies.db"),
+            "FSM_DB_PATH": os.path.join(workdir, "fsm.db"),
+            "BOT_MODE": "polling",
+            "WORKERS": "1",
+        }
+    )
+    if not args.telegram_limits:
+        # Measure the bot rather than the outbound throttle
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_CHAT_RATE": "1000000", "SEND_GROUP_RATE": "1000000"})
+
+    # Imported late so the settings above are what app.config reads
+    import main
+    from app import db
+    from app.polling import run_polling
+
+    codes = await _seed(db, args.movies)
+    tracker = Tracker()
+    forwarder = threading.Thread(target=_forward_sends, args=(api, tracker, asyncio.get_running_loop()), daemon=True)
+    forwarder.start()
+    bot = main.create_bot()
+    dp = main.create_dispatcher()
+    dp.update.outer_middleware(tracker.middleware)
+    stop = asyncio.Event()
+    polling = asyncio.create_task(run_polling(dp, bot, polling_timeout=1, handle_signals=False, stop=stop))
+
+    generator = LoadGenerator(api, tracker, args, codes)
+    admins = asyncio.create_task(generator.admins())
+    futures = await generator.users()
+    pending = list(futures) + [admins]
+    _, not_done = await asyncio.wait(pending, timeout=args.timeout)
+    # Replies go out before handlers finish (FSM writes, logging); let them complete
+    if tracker.in_flight:
+        await asyncio.wait_for(tracker.idle.wait(), args.timeout)
+
+    stop.set()
+    await polling
+    await bot.session.close()
+    calls, rate_limited = api.stop()
+    forwarder.join()
+
+    duration = tracker.last_done - (tracker.first_start or tracker.last_done)
+    completed = sum(len(values) for values in tracker.latencies.values())
+    return {
+        "revision": _git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items() if key != "compare"},
+        "completed": completed,
+        "timed_out": len(not_done),
+        "updates_per_sec": completed / duration if duration else 0.0,
+        "rate_limited": rate_limited,
+        "api_calls": calls,
+        "scenarios": {
+            label: {
+                "count": len(values),
+                "p50_ms": _percentile(values, 50) * 1000,
+                "p99_ms": _percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000,
+            }
+            for label, values in sorted(tracker.latencies.items())
+        },
+    }
+
+
+def _report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    def delta(current: float, previous: Optional[float]) -> str:
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous:+.0%})"
+
+    previous = (baseline or {}).get("scenarios", {})
+    print(f"{'scenario':<24}{'count':>8}{'p50 ms':>18}{'p99 ms':>18}{'max ms':>10}")
+    for label, stats in result["scenarios"].items():
+        old = previous.get(label, {})
+        p50 = f"{stats['p50_ms']:.1f}{delta(stats['p50_ms'], old.get('p50_ms'))}"
+        p99 = f"{stats['p99_ms']:.1f}{delta(stats['p99_ms'], old.get('p99_ms'))}"
+        print(f"{label:<24}{stats['count']:>8}{p50:>18}{p99:>18}{stats['max_ms']:>10.1f}")
+    throughput = f"{result['updates_per_sec']:.0f}"
+    if baseline:
+        throughput += delta(result["updates_per_sec"], baseline.get("updates_per_sec"))
+        print(f"\nbaseline: {baseline['revision']} at {baseline['timestamp']}")
+    print(f"updates/sec: {throughput}")
+    print(f"completed: {result['completed']}, timed out: {result['timed_out']}, 429s injected: {result['rate_limited']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=5000, help="user updates to send")
+    parser.add_argument("--rate", type=float, default=500, help="user updates per second (open loop)")
+    parser.add_argument("--users", type=int, default=2000, help="distinct member and non-member users")
+    parser.add_argument("--movies", type=int, default=10000, help="movies seeded into the catalog")
+    parser.add_argument("--admins", type=int, default=2, help="admins running /add concurrently")
+    parser.add_argument("--admin-flows", type=int, default=5, help="/add flows per admin")
+    parser.add_argument("--latency-ms", type=float, default=0, help="fake Bot API response latency")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="share of send* calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after reported with injected 429s")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the production send rate limits")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for outstanding updates")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", type=Path, help="result file to compare against (default: latest saved)")
+    parser.add_argument("--no-save", action="store_true", help="do not write the result file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING)
+    saved = sorted(RESULTS_DIR.glob("*.json"))
+    baseline_path = args.compare or (saved[-1] if saved else None)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path else None
+
+    result = asyncio.run(run(args))
+    _report(result, baseline)
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{result['revision']}.json"
+        path.write_text(json.dumps(result, indent=2))
+        print(f"saved: {path}")
+    sys.exit(1 if result["timed_out"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,89 @@
+import time
+
+# Taken before the heavy imports so the startup log covers them
+_LAUNCHED = time.perf_counter()
+
 import asyncio
 import logging
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from app import handlers
-from app.config import BOT_TOKEN, validate_config
+from app import db, handlers, jobs, metrics
+from app.antiflood import flood_control
+from app.config import (
+    BOT_MODE,
+    BOT_TOKEN,
+    FSM_DB_PATH,
+    FSM_STORAGE,
+    METRICS_HOST,
+    METRICS_PORT,
+    TELEGRAM_API_URL,
+    WORKERS,
+    validate_config,
+)
+from app.fsm_storage import SQLiteStorage
+from app.polling import run_polling
+from app.services.sender import send_scheduler
+from app.webhook import run_webhook
+from app.workers import run_workers
 
 
-async def main():
-    validate_config()
-    logging.basicConfig(level=logging.INFO)
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="Markdown"))
-    dp = Dispatcher(storage=MemoryStorage())
+def create_bot() -> Bot:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="Markdown"))
+    bot.session.middleware(send_scheduler)
+    bot.session.middleware(metrics.ApiMetrics())
+    return bot
+
+
+def create_storage() -> BaseStorage:
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(FSM_DB_PATH)
+    return MemoryStorage()
+
+
+async def _log_startup():
+    # Process launch to ready: imports, database open/migrations, catalog load and jobs
+    logging.info("Started in %.0f ms", (time.perf_counter() - _LAUNCHED) * 1000)
+
+
+def create_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=create_storage())
+    # Before metrics, so dropped floods cost as little as possible
+    dp.update.outer_middleware(flood_control)
+    metrics.setup(dp)
     dp.include_router(handlers.admin.router)
     dp.include_router(handlers.join.router)
     dp.include_router(handlers.user.router)
-    await dp.start_polling(bot)
+    dp.startup.register(db.init)
+    dp.startup.register(jobs.start_jobs)
+    dp.startup.register(_log_startup)
+    dp.shutdown.register(jobs.stop_jobs)
+    return dp
+
+
+async def main():
+    validate_config()
+    logging.basicConfig(level=logging.INFO)
+    if WORKERS > 1:
+        await run_workers(create_bot, create_dispatcher)
+        return
+    bot = create_bot()
+    dp = create_dispatcher()
+    metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await run_polling(dp, bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":